@@ -0,0 +1,110 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from kivy.clock import Clock
+
+
+# Worker threads shared by every screen for slow work (decryption, geocoding, map data...)
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='background')
+
+
+class BackgroundTask:
+    # Runs func(task, *args) on a worker thread. The function can stream partial results with
+    # task.emit(batch); on_batch, on_done and on_error are always called on the Kivy main thread,
+    # and never once the task has been cancelled.
+    def __init__(self, func, *args, on_batch=None, on_done=None, on_error=None):
+        self.func = func
+        self.args = args
+        self.on_batch = on_batch
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def start(self):
+        self.future = executor.submit(self.run)
+        return self
+
+    def run(self):
+        if self.is_cancelled:
+            return
+        try:
+            result = self.func(self, *self.args)
+        except Exception as e:
+            logging.exception(f"Background task {getattr(self.func, '__name__', self.func)} failed")
+            self.dispatch(self.on_error, e)
+            return
+        self.dispatch(self.on_done, result)
+
+    def emit(self, batch):
+        self.dispatch(self.on_batch, batch)
+
+    def dispatch(self, callback, *args):
+        if callback is None or self.is_cancelled:
+            return
+
+        def call(dt):
+            # The task may have been cancelled while waiting for the next frame
+            if not self.is_cancelled:
+                callback(*args)
+
+        Clock.schedule_once(call, 0)
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+
+class DatabaseWorker:
+    # One dedicated thread for database calls, so the Kivy main thread never waits on SQLite.
+    # submit(func, *args) returns a Future; on_done(result) / on_error(exception) are called on the
+    # main thread. Calls submitted with the same key while an earlier one hasn't started yet are
+    # coalesced: func runs once and every caller gets its result.
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+        self.lock = threading.Lock()
+        # key -> (future, [(on_done, on_error), ...]) of the calls still waiting in the queue
+        self.queued = {}
+
+    def submit(self, func, *args, on_done=None, on_error=None, key=None):
+        with self.lock:
+            if key is not None and key in self.queued:
+                future, callbacks = self.queued[key]
+                callbacks.append((on_done, on_error))
+                return future
+            callbacks = [(on_done, on_error)]
+            future = self.executor.submit(self.run, key, func, args)
+            if key is not None:
+                self.queued[key] = (future, callbacks)
+        future.add_done_callback(lambda done: self.dispatch(func, done, callbacks))
+        return future
+
+    def run(self, key, func, args):
+        if key is not None:
+            # Started: a call submitted from now on may need newer data, so it gets its own run
+            with self.lock:
+                self.queued.pop(key, None)
+        return func(*args)
+
+    def dispatch(self, func, future, callbacks):
+        def call(dt):
+            error = future.exception()
+            if error is not None:
+                logging.error(f"Database call {getattr(func, '__name__', func)} failed: {error}")
+            for on_done, on_error in callbacks:
+                if error is None:
+                    if on_done is not None:
+                        on_done(future.result())
+                elif on_error is not None:
+                    on_error(error)
+
+        Clock.schedule_once(call, 0)
+
+
+# Shared by every screen
+database_worker = DatabaseWorker()
@@ -0,0 +1,81 @@
+import re
+import threading
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def fts_query(search_text):
+    # Turn what the user typed into an FTS5 query: every word must match, as a prefix.
+    # Each word is quoted so characters like " or * can't break the query syntax.
+    tokens = tokenize(search_text)
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+class PrivateCommentIndex:
+    # Private comments are encrypted, so they can't go in the FTS table. Each user gets an
+    # in-memory index of their own private comments instead (never written to disk), filled
+    # incrementally so only new or changed comments are ever decrypted.
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user_id -> {'comments': {comment_id: (row, words)}, 'last_id': int, 'last_seq': int}
+        self.users = {}
+
+    def get_state(self, user_id):
+        # (last comment id, last comment_changes seq) already applied, None if never loaded
+        entry = self.users.get(user_id)
+        if entry is None:
+            return None
+        return entry['last_id'], entry['last_seq']
+
+    def update(self, user_id, rows, removed_ids, last_id, last_seq):
+        # rows are decrypted comments (comment text at index 3, topic at index 2)
+        entry = self.users.setdefault(user_id, {'comments': {}, 'last_id': 0, 'last_seq': 0})
+        for comment_id in removed_ids:
+            entry['comments'].pop(comment_id, None)
+        for row in rows:
+            entry['comments'][row[0]] = (row, set(tokenize(row[2]) + tokenize(row[3])))
+        entry['last_id'] = max(entry['last_id'], last_id)
+        entry['last_seq'] = max(entry['last_seq'], last_seq)
+
+    def reset(self, user_id):
+        # Drops the user's index, it's filled again from scratch (caller holds self.lock, like update)
+        self.users.pop(user_id, None)
+
+    def oldest_seq(self):
+        # The oldest comment_changes seq an index still has to apply the changes after, None if none is loaded
+        with self.lock:
+            return min((entry['last_seq'] for entry in self.users.values()), default=None)
+
+    def search(self, user_id, search_text):
+        tokens = tokenize(search_text)
+        entry = self.users.get(user_id)
+        if not tokens or entry is None:
+            return []
+        results = []
+        for row, words in entry['comments'].values():
+            score = 0
+            for token in tokens:
+                hits = sum(1 for word in words if word.startswith(token))
+                if not hits:
+                    break
+                score += hits
+            else:
+                results.append((score, row))
+        # Best matches first, newest first on a tie
+        results.sort(key=lambda result: (-result[0], -result[1][0]))
+        return [row for score, row in results]
+
+    def clear(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.users.clear()
+            else:
+                self.users.pop(user_id, None)
+
+
+# Shared by every DatabaseManager
+private_comment_index = PrivateCommentIndex()
@@ -7,83 +7,134 @@ from kivy.uix.label import Label
 from kivy.uix.button import Button
 from kivy.graphics import RoundedRectangle, Color
 from cryptography.fernet import Fernet
-import sqlite3
 import datetime
 import logging
-from encryption_manager import EncryptionManager
+from encryption_manager import DecryptedMessageCache, EncryptionManager
+from background_tasks import database_worker
+from database_service import get_database_service
+from user_directory import get_user_directory
+from message_queries import (LATEST_FEED_SEQ, OLDEST_FEED_SEQ, PRUNE_FEED, THREAD_MESSAGES, USER_FEED_CHANGES,
+                            USER_THREAD_MESSAGES, pair_params)
 import os
 
 
+# Messages loaded at a time in a conversation
+MESSAGE_PAGE_SIZE = 30
+
+SEND_MESSAGE = "INSERT INTO messages (sender_id, receiver_id, message, timestamp, thread_id) VALUES (?, ?, ?, ?, ?)"
+
 # Get the key from the environment variable
 key = os.getenv("ENCRYPTION_KEY")
 # Create an instance of EncryptionManager
 encryption_manager = EncryptionManager(key)
 
+# Plaintext of the messages already shown, shared by every MessageManager
+decrypted_messages = DecryptedMessageCache()
+
 
 class MessageManager:
-    def __init__(self, user_id, username, key):
+    def __init__(self, user_id, username, key, db_path='comments.db'):
         self.user_id = user_id
         self.username = username
         self.key = key
         self.cipher_suite = Fernet(self.key)
-        self.conn = self.open_conn()
-        self.cursor = self.conn.cursor()
-
-    def open_conn(self):
-        return sqlite3.connect("comments.db")
+        self.encryption_manager = EncryptionManager(self.key)
+        self.db = get_database_service(db_path)
+        self.users = get_user_directory(db_path)
 
     def send_message(self, sender_id, receiver_id, message, thread_id):
         if isinstance(message, str) and thread_id is not None:
-            encrypted_message = self.cipher_suite.encrypt(message.encode())  # Encrypt the message
-            timestamp = datetime.datetime.utcnow()
-            self.cursor.execute(
-                "INSERT INTO messages (sender_id, receiver_id, message, timestamp, thread_id) VALUES (?, ?, ?, ?, ?)",
-                (sender_id, receiver_id, encrypted_message, timestamp, thread_id))
-            self.conn.commit()
-            return True
+            cursor = self.db.execute(SEND_MESSAGE, self.message_row(sender_id, receiver_id, message, thread_id))
+            return cursor.lastrowid  # The new message id
         else:
             print("Error: message is not a string or thread_id is None")
             return False
 
+    def message_row(self, sender_id, receiver_id, message, thread_id):
+        encrypted_message = self.cipher_suite.encrypt(message.encode())  # Encrypt the message
+        timestamp = datetime.datetime.utcnow()
+        return sender_id, receiver_id, encrypted_message, timestamp, thread_id
+
     def get_messages(self, thread_id, sender_id, receiver_id):
         if thread_id is not None:
-            self.cursor.execute(
-                "SELECT id, sender_id, message, timestamp FROM messages WHERE thread_id=? AND ((sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)) ORDER BY timestamp ASC",
-                (thread_id, sender_id, receiver_id, receiver_id, sender_id,))
-            messages = self.cursor.fetchall()
-            decrypted_messages = [(msg[0], msg[1], self.cipher_suite.decrypt(msg[2]).decode(), msg[3]) for msg in
-                                  messages]  # Decrypt the message
-            return decrypted_messages
+            messages = self.db.fetchall(THREAD_MESSAGES + " ORDER BY timestamp ASC",
+                                        (thread_id,) + pair_params(sender_id, receiver_id))
+            return self.read_messages(messages)
         else:
             return []
 
-    def delete_message(self, message_id, message_bubble):
+    def get_messages_page(self, thread_id, sender_id, receiver_id, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+        # Keyset pagination on (timestamp, id): the page just before `before`, just after `after`,
+        # or the latest page. Messages are always returned oldest first.
+        if thread_id is None:
+            return []
+        query = THREAD_MESSAGES
+        params = [thread_id, *pair_params(sender_id, receiver_id)]
+        if after is not None:
+            query += " AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?"
+            params += [after[0], after[1], limit]
+        else:
+            if before is not None:
+                query += " AND (timestamp, id) < (?, ?)"
+                params += [before[0], before[1]]
+            query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+            params.append(limit)
+        messages = self.db.fetchall(query, params)
+        if after is None:
+            messages.reverse()
+        return self.read_messages(messages)
+
+    def read_messages(self, messages):
+        # (id, sender_id, text, timestamp) of THREAD_MESSAGES rows. The sender names come with the
+        # rows, so they go straight into the user directory instead of being looked up one by one.
+        for message_id, sender_id, message, timestamp, sender_name in messages:
+            self.users.remember(sender_id, sender_name)
+        texts = self.decrypt_messages([(message[0], message[2]) for message in messages])
+        return [(message[0], message[1], text, message[3]) for message, text in zip(messages, texts)]
+
+    def decrypt_messages(self, messages):
+        # [(message_id, ciphertext)] -> plaintexts, through the cache of already decrypted messages
+        return decrypted_messages.decrypt(self.encryption_manager, messages)
+
+    def delete_message(self, message_id, message_bubble=None):
         try:
-            self.cursor.execute("DELETE FROM messages WHERE id=?", (message_id,))
-            self.conn.commit()
-            message_bubble.parent.remove_widget(message_bubble)  # Remove the message bubble from the UI
+            self.db.execute("DELETE FROM messages WHERE id=?", (message_id,))
+            decrypted_messages.discard(message_id)
+            if message_bubble is not None and message_bubble.parent:
+                message_bubble.parent.remove_widget(message_bubble)  # Remove the message bubble from the UI
             return True
         except Exception as e:
             logging.error(f"An error occurred: {e}")
             return False
 
     def get_user_id(self, username):
-        self.cursor.execute("SELECT id FROM users WHERE username=?", (username,))
-        user_id = self.cursor.fetchone()
-        return user_id[0] if user_id else None
+        return self.users.user_id(username)
 
     def get_threads_messages(self, user_id, thread_id):
-        self.cursor.execute("""
-            SELECT message, timestamp FROM messages 
-            WHERE (sender_id=? OR receiver_id=?) AND thread_id=?
-            ORDER BY timestamp DESC
-        """, (user_id, user_id, thread_id))
-        messages = self.cursor.fetchall()
-        decrypted_messages = [(self.cipher_suite.decrypt(msg[0]).decode(), msg[1]) for msg in messages]
-        return decrypted_messages if messages else []
+        messages = self.db.fetchall(USER_THREAD_MESSAGES, (thread_id, user_id, user_id))
+        texts = self.decrypt_messages([(msg[0], msg[1]) for msg in messages])
+        return [(text, msg[2]) for msg, text in zip(messages, texts)]
+
+    def poll_since(self, seq):
+        # Messages sent to or by this user, or deleted, since feed position seq (None: from now on).
+        # Returns ([(seq, change, message_id, thread_id, sender_id, receiver_id)], the new position).
+        # The changes are None if some of them were pruned already (see prune_feed).
+        with self.db.reader() as conn:
+            latest_seq = conn.execute(LATEST_FEED_SEQ).fetchone()[0] or 0
+            if seq is None or seq >= latest_seq:
+                return [], max(latest_seq, seq or 0)
+            if conn.execute(OLDEST_FEED_SEQ).fetchone()[0] > seq + 1:
+                return None, latest_seq
+            changes = conn.execute(USER_FEED_CHANGES, (seq, latest_seq, self.user_id, self.user_id)).fetchall()
+        return changes, latest_seq
+
+    def prune_feed(self, up_to_seq):
+        # Database thread: forgets the feed changes up to up_to_seq, but the latest one
+        return self.db.execute(PRUNE_FEED, (up_to_seq,)).rowcount
 
     def close(self):
-        self.conn.close()
+        # The connections belong to the shared DatabaseService and stay open
+        pass
 
 
 class CommentManager:
@@ -91,15 +142,31 @@ class CommentManager:
         self.db_manager = db_manager
         self.api_manager = api_manager
 
-    def get_comments_with_locations(self):
-        user_id = App.get_running_app().user_id
-        comments = self.db_manager.get_comments(user_id)
+    def get_comments_with_locations(self, bbox=None, limit=None, comment_ids=None, user_id=None):
+        return self.locate_comments(self.get_comments(bbox, limit, comment_ids, user_id))
+
+    def get_comments(self, bbox=None, limit=None, comment_ids=None, user_id=None):
+        if user_id is None:
+            user_id = App.get_running_app().user_id
+        if comment_ids is not None:
+            return self.db_manager.get_comments_by_ids(user_id, comment_ids)
+        if bbox is None:
+            return self.db_manager.get_comments(user_id)
+        # Only what's inside (lat_min, lon_min, lat_max, lon_max)
+        return self.db_manager.get_comments_in_bbox(user_id, *bbox, limit=limit)
+
+    def locate_comments(self, comments):
         comments_with_locations = []
 
-        for id_, user_id, topic, comment, location, is_encrypted, is_anonymous, anonymous_username, username, timestamp in comments:
-            lat_lng = self.api_manager.get_location_coordinates(location)
-            if lat_lng:
-                lat, lon = lat_lng['lat'], lat_lng['lng']
+        for (id_, user_id, topic, comment, location, is_encrypted, is_anonymous, anonymous_username, username, timestamp,
+             lat, lon) in comments:
+            if lat is None:
+                # Not geocoded yet (the backfill job hasn't reached it), do it now and store it
+                lat_lng = self.api_manager.get_location_coordinates(location)
+                if lat_lng:
+                    lat, lon = lat_lng['lat'], lat_lng['lng']
+                    self.db_manager.update_comment_coordinates(id_, lat, lon)
+            if lat is not None:
                 if is_anonymous:
                     anonymous_username = 'Anonymous'
                 else:
@@ -127,38 +194,51 @@ class CommentBubble(Bubble):
             Color(1, 1, 1, 1)
             self.rect = RoundedRectangle(size=box.size, pos=box.pos)
 
-        if is_anonymous:
-            lbl = Label(text="(Posted by: Anonymous)", color=(0, 0, 0, 1),
-                        size_hint_y=None)
-        else:
-            lbl = Label(text=f"Posted by: {user_id}", bold=True, color=(0, 0, 0, 1), size_hint_y=None)
-        box.add_widget(lbl)
+        self.author_lbl = Label(color=(0, 0, 0, 1), size_hint_y=None)
+        box.add_widget(self.author_lbl)
 
-        lbl = Label(text=comment, color=(0, 0, 0, 1), size_hint_y=None)
+        self.comment_lbl = Label(color=(0, 0, 0, 1), size_hint_y=None)
 
-        lbl.text_size = (self.width * .9, None)
-        lbl.halign = 'center'
-        lbl.valign = 'middle'
-        lbl.bind(texture_size=lbl.setter('size'))
-        box.add_widget(lbl)
+        self.comment_lbl.text_size = (self.width * .9, None)
+        self.comment_lbl.halign = 'center'
+        self.comment_lbl.valign = 'middle'
+        self.comment_lbl.bind(texture_size=self.comment_lbl.setter('size'))
+        box.add_widget(self.comment_lbl)
 
         # Create a new BoxLayout for the timestamp and the 'Message' button
-        bottom_box = BoxLayout(orientation='horizontal', size_hint_y=None, height="30dp", spacing=10, padding=[5, 15, 5, 5])
+        self.bottom_box = BoxLayout(orientation='horizontal', size_hint_y=None, height="30dp", spacing=10, padding=[5, 15, 5, 5])
 
-        if not is_anonymous:
-            self.message_button = Button(text='Message', size_hint_x=None, width="60dp", height=25)
-            self.message_button.bind(on_release=self.go_to_message_screen)
-            bottom_box.add_widget(self.message_button)
+        # Only shown for comments that aren't anonymous
+        self.message_button = Button(text='Message', size_hint_x=None, width="60dp", height=25)
+        self.message_button.bind(on_release=self.go_to_message_screen)
 
-        timestamp_lbl = Label(text=timestamp, color=(0, 0, 0, 0.5), size_hint_x=None, width="60dp", font_size='10sp')
-        bottom_box.add_widget(timestamp_lbl)
+        self.timestamp_lbl = Label(color=(0, 0, 0, 0.5), size_hint_x=None, width="60dp", font_size='10sp')
+        self.bottom_box.add_widget(self.timestamp_lbl)
 
-        box.add_widget(bottom_box)
+        box.add_widget(self.bottom_box)
 
 
         self.add_widget(box)
 
         box.bind(size=self.update_rect, pos=self.update_rect)
+        self.set_comment(comment, is_anonymous, user_id, timestamp)
+
+    def set_comment(self, comment, is_anonymous, user_id, timestamp):
+        # Fill the bubble with a comment, used again when the bubble is recycled
+        self.user_id = user_id
+        if is_anonymous:
+            self.author_lbl.text = "(Posted by: Anonymous)"
+            self.author_lbl.bold = False
+        else:
+            self.author_lbl.text = f"Posted by: {user_id}"
+            self.author_lbl.bold = True
+        self.comment_lbl.text = comment
+        self.timestamp_lbl.text = timestamp or ''
+
+        if is_anonymous and self.message_button.parent:
+            self.bottom_box.remove_widget(self.message_button)
+        elif not is_anonymous and not self.message_button.parent:
+            self.bottom_box.add_widget(self.message_button, index=len(self.bottom_box.children))
 
     def update_rect(self, instance, value):
         self.rect.pos = instance.pos
@@ -166,38 +246,79 @@ class CommentBubble(Bubble):
 
     def go_to_message_screen(self, instance):
         from main import DatabaseManager
-        # Fetch the receiver_id from the database
-        database_manager = DatabaseManager("comments.db")
-        receiver_id = database_manager.fetch_user_id(self.user_id)
+        message_screen = self.screen_manager.get_screen('message_screen')
+        sender_id = message_screen.sender_id
+        database_worker.submit(self.find_thread, DatabaseManager("comments.db"), sender_id, self.user_id,
+                               on_done=lambda result: self.open_conversation(sender_id, *result))
 
+    def find_thread(self, database_manager, sender_id, username):
+        # Database thread: the receiver_id and the thread of the conversation
+        receiver_id = database_manager.fetch_user_id(username)
+        return receiver_id, database_manager.get_or_create_thread_id(sender_id, receiver_id)
+
+    def open_conversation(self, sender_id, receiver_id, thread_id):
         # Set the receiver_id in MessageScreen
         message_screen = self.screen_manager.get_screen('message_screen')
-        sender_id = message_screen.sender_id
         message_screen.receiver_id = receiver_id
-        thread_id = database_manager.get_thread_id(sender_id, receiver_id)
-        if thread_id is None:
-            thread_id = database_manager.create_new_thread_id()
         message_screen.thread_id = thread_id  # Set thread_id before calling update_messages
         message_screen.update_messages(sender_id, receiver_id, thread_id)
         self.screen_manager.current = 'message_screen'
 
 
+class CommentBubblePool:
+    # Keeps a few hidden bubbles around so opening a marker doesn't build a new widget tree
+    def __init__(self, max_size=10):
+        self.max_size = max_size
+        self.bubbles = []
+
+    def acquire(self, comment, is_anonymous, user_id, timestamp, screen_manager):
+        if self.bubbles:
+            bubble = self.bubbles.pop()
+            bubble.screen_manager = screen_manager
+            bubble.set_comment(comment, is_anonymous, user_id, timestamp)
+            return bubble
+        return CommentBubble(comment, is_anonymous, user_id, timestamp, screen_manager)
+
+    def release(self, bubble):
+        if bubble.parent:
+            bubble.parent.remove_widget(bubble)
+        if len(self.bubbles) < self.max_size:
+            self.bubbles.append(bubble)
+
+
+# Shared by every CommentMarker
+bubble_pool = CommentBubblePool()
+
+
 class CommentMarker(MapMarkerPopup):
     def __init__(self, comment, is_anonymous, username, timestamp, color1, screen_manager, **kwargs):
         super(CommentMarker, self).__init__(**kwargs)
         self.color = get_color_from_hex(color1)
         self.comment = comment
-        # Create a bubble and add it to the marker
-        self.bubble = CommentBubble(comment, is_anonymous, username,timestamp, screen_manager)
-        self.add_widget(self.bubble)
-        # Initially make the bubble invisible
-        self.bubble.opacity = 0
+        self.is_anonymous = is_anonymous
+        self.username = username
+        self.timestamp = timestamp
+        self.screen_manager = screen_manager
+        # The bubble is only created when the marker is opened
+        self.bubble = None
         self.bind(on_release=self.show_comment)
 
     def show_comment(self, *args):
-        if self.bubble.opacity == 0:
-            # Show the bubble
-            self.bubble.opacity = 1
-        else:
-            # Hide the bubble
-            self.bubble.opacity = 0
+        # Runs before MapMarkerPopup.on_release opens the popup, so the bubble is ready in time
+        if self.bubble is None:
+            self.bubble = bubble_pool.acquire(self.comment, self.is_anonymous, self.username, self.timestamp,
+                                              self.screen_manager)
+            self.add_widget(self.bubble)
+
+    def on_is_open(self, *args):
+        super(CommentMarker, self).on_is_open(*args)
+        if not self.is_open:
+            # Closed, give the bubble back to the pool
+            self.release_bubble()
+
+    def release_bubble(self):
+        if self.bubble is None:
+            return
+        bubble_pool.release(self.bubble)
+        self.bubble = None
+        self.is_open = False
@@ -0,0 +1,477 @@
+import sqlite3
+import threading
+
+
+# Each migration upgrades the database by one version (stored in PRAGMA user_version).
+# Never edit a migration once it has shipped, append a new one instead.
+
+def create_tables(cursor):
+    # Tables the app was originally created with, for fresh databases
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            admin INTEGER NOT NULL DEFAULT 0
+        , salt TEXT, logged_in INTEGER DEFAULT 0)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            topic TEXT NOT NULL,
+            comment TEXT NOT NULL,
+            location TEXT NOT NULL, is_private INTEGER DEFAULT 0, is_encrypted INTEGER DEFAULT 0, is_anonymous INTEGER DEFAULT 0, anonymous_username TEXT, username text, timestamp DATETIME,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            sender_id INTEGER,
+            receiver_id INTEGER,
+            message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, thread_id INTEGER,
+            FOREIGN KEY(sender_id) REFERENCES users(id),
+            FOREIGN KEY(receiver_id) REFERENCES users(id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON messages (timestamp)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS threads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT
+        )
+    """)
+
+
+def add_comment_coordinates(cursor):
+    # Geocoded position of comments.location, NULL until geocoded
+    cursor.execute("ALTER TABLE comments ADD COLUMN lat REAL")
+    cursor.execute("ALTER TABLE comments ADD COLUMN lon REAL")
+
+
+def add_comments_rtree(cursor):
+    # Spatial index over comments.lat/lon, kept in sync by triggers
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS comments_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO comments_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, lat, lat, lon, lon FROM comments WHERE lat IS NOT NULL AND lon IS NOT NULL
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comments_rtree_insert AFTER INSERT ON comments
+        WHEN new.lat IS NOT NULL AND new.lon IS NOT NULL
+        BEGIN
+            INSERT INTO comments_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            VALUES (new.id, new.lat, new.lat, new.lon, new.lon);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comments_rtree_update AFTER UPDATE OF lat, lon ON comments
+        BEGIN
+            DELETE FROM comments_rtree WHERE id = old.id;
+            INSERT INTO comments_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT new.id, new.lat, new.lat, new.lon, new.lon
+            WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comments_rtree_delete AFTER DELETE ON comments
+        BEGIN
+            DELETE FROM comments_rtree WHERE id = old.id;
+        END
+    """)
+
+
+def add_comment_changes(cursor):
+    # Log of updated/deleted comments so the map can apply only what changed since its last visit.
+    # New comments don't need an entry, they are found by id.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS comment_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            comment_id INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comment_changes_update
+        AFTER UPDATE OF topic, comment, is_private, lat, lon ON comments
+        BEGIN
+            INSERT INTO comment_changes (comment_id) VALUES (new.id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comment_changes_delete AFTER DELETE ON comments
+        BEGIN
+            INSERT INTO comment_changes (comment_id) VALUES (old.id);
+        END
+    """)
+
+
+def add_comments_fts(cursor):
+    # Full-text index over the topic and text of comments that aren't encrypted,
+    # kept in sync by triggers. Encrypted comments are searched in memory (see comment_search.py).
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(
+            topic, comment, content='comments', content_rowid='id'
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO comments_fts (rowid, topic, comment)
+        SELECT id, topic, comment FROM comments WHERE is_encrypted = 0
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comments_fts_insert AFTER INSERT ON comments
+        WHEN new.is_encrypted = 0
+        BEGIN
+            INSERT INTO comments_fts (rowid, topic, comment) VALUES (new.id, new.topic, new.comment);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comments_fts_update AFTER UPDATE OF topic, comment, is_encrypted ON comments
+        BEGIN
+            INSERT INTO comments_fts (comments_fts, rowid, topic, comment)
+            SELECT 'delete', old.id, old.topic, old.comment WHERE old.is_encrypted = 0;
+            INSERT INTO comments_fts (rowid, topic, comment)
+            SELECT new.id, new.topic, new.comment WHERE new.is_encrypted = 0;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS comments_fts_delete AFTER DELETE ON comments
+        WHEN old.is_encrypted = 0
+        BEGIN
+            INSERT INTO comments_fts (comments_fts, rowid, topic, comment)
+            VALUES ('delete', old.id, old.topic, old.comment);
+        END
+    """)
+
+
+def add_conversations(cursor):
+    # One row per user and conversation partner, so the user list doesn't have to scan messages.
+    # Kept up to date by triggers on messages.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            partner_id INTEGER NOT NULL,
+            thread_id INTEGER,
+            last_message_id INTEGER,
+            last_message_at DATETIME,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, partner_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (user_id, last_message_at)
+    """)
+    # Existing messages count as read
+    cursor.execute("""
+        INSERT OR REPLACE INTO conversations (user_id, partner_id, thread_id, last_message_id, last_message_at)
+        SELECT user_id, partner_id, thread_id, id, MAX(timestamp) FROM (
+            SELECT id, sender_id AS user_id, receiver_id AS partner_id, thread_id, timestamp FROM messages
+            UNION ALL
+            SELECT id, receiver_id, sender_id, thread_id, timestamp FROM messages
+        )
+        WHERE user_id IS NOT NULL AND partner_id IS NOT NULL AND user_id != partner_id
+        GROUP BY user_id, partner_id
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_insert AFTER INSERT ON messages
+        WHEN new.sender_id != new.receiver_id
+        BEGIN
+            INSERT INTO conversations (user_id, partner_id, thread_id, last_message_id, last_message_at)
+            VALUES (new.sender_id, new.receiver_id, new.thread_id, new.id, new.timestamp)
+            ON CONFLICT (user_id, partner_id) DO UPDATE SET
+                thread_id = excluded.thread_id,
+                last_message_id = excluded.last_message_id,
+                last_message_at = excluded.last_message_at;
+            INSERT INTO conversations (user_id, partner_id, thread_id, last_message_id, last_message_at, unread_count)
+            VALUES (new.receiver_id, new.sender_id, new.thread_id, new.id, new.timestamp, 1)
+            ON CONFLICT (user_id, partner_id) DO UPDATE SET
+                thread_id = excluded.thread_id,
+                last_message_id = excluded.last_message_id,
+                last_message_at = excluded.last_message_at,
+                unread_count = unread_count + 1;
+        END
+    """)
+    # Only the last message of a conversation matters, fall back to the one before it
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE conversations SET
+                last_message_id = (
+                    SELECT id FROM messages
+                    WHERE (sender_id = conversations.user_id AND receiver_id = conversations.partner_id)
+                       OR (sender_id = conversations.partner_id AND receiver_id = conversations.user_id)
+                    ORDER BY timestamp DESC, id DESC LIMIT 1),
+                last_message_at = (
+                    SELECT timestamp FROM messages
+                    WHERE (sender_id = conversations.user_id AND receiver_id = conversations.partner_id)
+                       OR (sender_id = conversations.partner_id AND receiver_id = conversations.user_id)
+                    ORDER BY timestamp DESC, id DESC LIMIT 1)
+            WHERE last_message_id = old.id
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+            DELETE FROM conversations
+            WHERE last_message_id IS NULL
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+        END
+    """)
+
+
+def add_message_indexes(cursor):
+    # Indexes for the hot message queries in message_queries.py. A conversation is looked up
+    # through its normalized (lowest, highest) participant ids, whoever sent the message.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages (thread_id, timestamp, id)")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (
+            min(sender_id, receiver_id), max(sender_id, receiver_id), timestamp, id
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, thread_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, thread_id)")
+    # Same as before, but finds the previous message through idx_messages_pair
+    cursor.execute("DROP TRIGGER IF EXISTS conversations_delete")
+    cursor.execute("""
+        CREATE TRIGGER conversations_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE conversations SET
+                last_message_id = (
+                    SELECT id FROM messages
+                    WHERE min(sender_id, receiver_id) = min(conversations.user_id, conversations.partner_id)
+                      AND max(sender_id, receiver_id) = max(conversations.user_id, conversations.partner_id)
+                    ORDER BY timestamp DESC, id DESC LIMIT 1),
+                last_message_at = (
+                    SELECT timestamp FROM messages
+                    WHERE min(sender_id, receiver_id) = min(conversations.user_id, conversations.partner_id)
+                      AND max(sender_id, receiver_id) = max(conversations.user_id, conversations.partner_id)
+                    ORDER BY timestamp DESC, id DESC LIMIT 1)
+            WHERE last_message_id = old.id
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+            DELETE FROM conversations
+            WHERE last_message_id IS NULL
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+        END
+    """)
+    cursor.execute("ANALYZE messages")
+
+
+def add_thread_participants(cursor):
+    # The thread of each pair of users, (user_lo, user_hi) being the lowest and highest id.
+    # Replaces finding a conversation's thread through its newest message.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS thread_participants (
+            thread_id INTEGER PRIMARY KEY,
+            user_lo INTEGER NOT NULL,
+            user_hi INTEGER NOT NULL,
+            UNIQUE (user_lo, user_hi),
+            FOREIGN KEY(thread_id) REFERENCES threads(id)
+        )
+    """)
+    # Existing pairs keep the thread of their newest message...
+    cursor.execute("""
+        INSERT OR IGNORE INTO thread_participants (thread_id, user_lo, user_hi)
+        SELECT thread_id, user_lo, user_hi FROM (
+            SELECT thread_id, min(sender_id, receiver_id) AS user_lo, max(sender_id, receiver_id) AS user_hi,
+                   MAX(timestamp)
+            FROM messages
+            WHERE thread_id IS NOT NULL AND sender_id IS NOT NULL AND receiver_id IS NOT NULL
+            GROUP BY user_lo, user_hi
+        )
+    """)
+    # ...and their older messages move to it, so the whole history shows up in the conversation
+    cursor.execute("""
+        UPDATE messages SET thread_id = (
+            SELECT thread_id FROM thread_participants
+            WHERE user_lo = min(messages.sender_id, messages.receiver_id)
+              AND user_hi = max(messages.sender_id, messages.receiver_id))
+        WHERE EXISTS (
+            SELECT 1 FROM thread_participants
+            WHERE user_lo = min(messages.sender_id, messages.receiver_id)
+              AND user_hi = max(messages.sender_id, messages.receiver_id)
+              AND thread_id != messages.thread_id)
+    """)
+    cursor.execute("""
+        UPDATE conversations SET thread_id = (
+            SELECT thread_id FROM thread_participants
+            WHERE user_lo = min(conversations.user_id, conversations.partner_id)
+              AND user_hi = max(conversations.user_id, conversations.partner_id))
+        WHERE EXISTS (
+            SELECT 1 FROM thread_participants
+            WHERE user_lo = min(conversations.user_id, conversations.partner_id)
+              AND user_hi = max(conversations.user_id, conversations.partner_id))
+    """)
+
+
+def add_username_index(cursor):
+    # Username -> id lookups (sign in, the user directory) without scanning users
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+
+
+def add_message_feed(cursor):
+    # Every message sent or deleted, in order. Open apps poll it from their last seq to show new
+    # messages without reloading threads, whichever app instance wrote them.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_feed (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            change TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            thread_id INTEGER,
+            sender_id INTEGER,
+            receiver_id INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS message_feed_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO message_feed (change, message_id, thread_id, sender_id, receiver_id)
+            VALUES ('insert', new.id, new.thread_id, new.sender_id, new.receiver_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS message_feed_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO message_feed (change, message_id, thread_id, sender_id, receiver_id)
+            VALUES ('delete', old.id, old.thread_id, old.sender_id, old.receiver_id);
+        END
+    """)
+
+
+def add_conversation_read_marker(cursor):
+    # conversations.last_read_id: user_id has read every message from partner_id up to this id and
+    # none after it, so deleting a message can tell whether it was still counted as unread
+    cursor.execute("ALTER TABLE conversations ADD COLUMN last_read_id INTEGER NOT NULL DEFAULT 0")
+    # The unread messages are the newest unread_count received ones
+    cursor.execute("""
+        UPDATE conversations SET last_read_id = coalesce((
+            SELECT max(id) FROM messages
+            WHERE sender_id = conversations.partner_id AND receiver_id = conversations.user_id), 0)
+        WHERE unread_count = 0
+    """)
+    unread = cursor.execute("SELECT user_id, partner_id, unread_count FROM conversations WHERE unread_count > 0").fetchall()
+    for user_id, partner_id, unread_count in unread:
+        row = cursor.execute("""
+            SELECT id FROM messages WHERE sender_id = ? AND receiver_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+        """, (partner_id, user_id, unread_count)).fetchone()
+        cursor.execute("UPDATE conversations SET last_read_id = ? WHERE user_id = ? AND partner_id = ?",
+                       (row[0] if row else 0, user_id, partner_id))
+    # Same as before, and a deleted unread message no longer counts as unread. Message ids are
+    # reused after the newest message is deleted, a marker past the last message is brought back
+    # so the next message isn't taken for a read one.
+    cursor.execute("DROP TRIGGER IF EXISTS conversations_delete")
+    cursor.execute("""
+        CREATE TRIGGER conversations_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE conversations SET unread_count = unread_count - 1
+            WHERE user_id = old.receiver_id AND partner_id = old.sender_id
+              AND unread_count > 0 AND old.id > last_read_id;
+            UPDATE conversations SET last_read_id = coalesce((SELECT max(id) FROM messages), 0)
+            WHERE last_read_id >= old.id AND last_read_id > coalesce((SELECT max(id) FROM messages), 0)
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+            UPDATE conversations SET
+                last_message_id = (
+                    SELECT id FROM messages
+                    WHERE min(sender_id, receiver_id) = min(conversations.user_id, conversations.partner_id)
+                      AND max(sender_id, receiver_id) = max(conversations.user_id, conversations.partner_id)
+                    ORDER BY timestamp DESC, id DESC LIMIT 1),
+                last_message_at = (
+                    SELECT timestamp FROM messages
+                    WHERE min(sender_id, receiver_id) = min(conversations.user_id, conversations.partner_id)
+                      AND max(sender_id, receiver_id) = max(conversations.user_id, conversations.partner_id)
+                    ORDER BY timestamp DESC, id DESC LIMIT 1)
+            WHERE last_message_id = old.id
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+            DELETE FROM conversations
+            WHERE last_message_id IS NULL
+              AND ((user_id = old.sender_id AND partner_id = old.receiver_id)
+                OR (user_id = old.receiver_id AND partner_id = old.sender_id));
+        END
+    """)
+
+
+def add_geocode_cache(cursor):
+    # Disk half of geocode_cache.GeocodeCache: OpenCage answers by normalized query, a "not found"
+    # has NULL coordinates. Databases opened by earlier versions already have the table.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_geocode_last_used ON geocode_cache (last_used)")
+
+
+def skip_geocoded_comment_changes(cursor):
+    # A comment getting its first coordinates isn't logged: backfill_coordinates would add a change
+    # for every old comment. Readers of the log that care (the map) are told another way.
+    cursor.execute("DROP TRIGGER IF EXISTS comment_changes_update")
+    cursor.execute("""
+        CREATE TRIGGER comment_changes_update
+        AFTER UPDATE OF topic, comment, is_private, lat, lon ON comments
+        WHEN NOT (old.lat IS NULL AND old.lon IS NULL AND new.lat IS NOT NULL AND new.lon IS NOT NULL
+                  AND new.topic IS old.topic AND new.comment IS old.comment AND new.is_private IS old.is_private)
+        BEGIN
+            INSERT INTO comment_changes (comment_id) VALUES (new.id);
+        END
+    """)
+
+
+MIGRATIONS = [
+    create_tables,
+    add_comment_coordinates,
+    add_comments_rtree,
+    add_comment_changes,
+    add_comments_fts,
+    add_conversations,
+    add_message_indexes,
+    add_thread_participants,
+    add_username_index,
+    add_message_feed,
+    add_conversation_read_marker,
+    add_geocode_cache,
+    skip_geocoded_comment_changes,
+]
+
+_migrated = set()
+_migrated_lock = threading.Lock()
+
+
+def migrate(conn):
+    cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return version
+    # Take the write lock first so two app instances can't migrate at the same time
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for number in range(version, len(MIGRATIONS)):
+            MIGRATIONS[number](cursor)
+        cursor.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return len(MIGRATIONS)
+
+
+def ensure_schema(db_path):
+    # Run the migrations once per database file and per process
+    with _migrated_lock:
+        if db_path in _migrated:
+            return
+        conn = sqlite3.connect(db_path)
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
+        _migrated.add(db_path)
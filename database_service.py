@@ -0,0 +1,275 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+from database_schema import ensure_schema
+
+
+# Read connections kept open per database file
+READER_POOL_SIZE = 4
+
+# Compiled statements each connection keeps around. The app's queries are constant strings,
+# so with long-lived connections every query is only prepared once per connection.
+CACHED_STATEMENTS = 256
+
+# How long a connection waits on a lock held by another process before giving up, in seconds
+BUSY_TIMEOUT = 10
+
+# Database calls are meant to run on the DatabaseWorker thread (background_tasks.py). One made on
+# the main thread blocks rendering, so it's timed and its call site logged, and the totals are logged
+# at exit. Run with RAISE_ON_MAIN_THREAD_IO=1 while developing to make such calls raise instead.
+RAISE_ON_MAIN_THREAD_IO = os.getenv('RAISE_ON_MAIN_THREAD_IO') == '1'
+
+# Group commit: queued writes are committed together once this many are waiting, or when the
+# oldest has waited this long (in seconds)
+GROUP_COMMIT_ROWS = 500
+GROUP_COMMIT_DELAY = 0.05
+
+
+class MainThreadIOMonitor:
+    # Counts the database calls made on the main thread and how long they blocked it
+    def __init__(self, raise_on_io=RAISE_ON_MAIN_THREAD_IO):
+        self.raise_on_io = raise_on_io
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+        self.longest = 0.0
+        self.call_sites = set()
+
+    @contextmanager
+    def watch(self):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        # The first frame outside this module is where the call comes from
+        call_site = next((f"{frame.filename}:{frame.lineno} in {frame.name}"
+                          for frame in reversed(traceback.extract_stack(limit=12))
+                          if not frame.filename.endswith(('database_service.py', 'contextlib.py'))), None)
+        if self.raise_on_io:
+            # Still counted, in case the caller swallows the error
+            with self.lock:
+                self.calls += 1
+                self.call_sites.add(call_site)
+            raise RuntimeError(f"Database call on the main thread from {call_site}")
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.calls += 1
+                self.seconds += elapsed
+                self.longest = max(self.longest, elapsed)
+                first_time = call_site not in self.call_sites
+                self.call_sites.add(call_site)
+            if first_time:
+                logging.warning(f"Database call on the main thread from {call_site} ({elapsed * 1000:.1f} ms)")
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'seconds': self.seconds, 'longest': self.longest,
+                    'call_sites': sorted(self.call_sites)}
+
+    def report(self):
+        # At exit: how much the main thread was blocked over the whole run
+        stats = self.stats()
+        if stats['calls']:
+            logging.warning(f"{stats['calls']} database calls on the main thread blocked it for "
+                            f"{stats['seconds'] * 1000:.0f} ms (longest {stats['longest'] * 1000:.1f} ms) "
+                            f"from {len(stats['call_sites'])} call sites")
+
+
+main_thread_io = MainThreadIOMonitor()
+atexit.register(main_thread_io.report)
+
+
+class DatabaseService:
+    # Owns every connection to one database file: a small pool of read connections and a single
+    # write connection. Writes are serialized through one lock, so threads of this process never
+    # fight over the SQLite write lock, and WAL mode lets the readers run while a write commits.
+    def __init__(self, db_path, reader_pool_size=READER_POOL_SIZE):
+        self.db_path = db_path
+        ensure_schema(db_path)
+        self.write_lock = threading.RLock()
+        self.write_conn = self.connect()
+        self.write_conn.execute("PRAGMA journal_mode=WAL")
+        self.readers = queue.LifoQueue()
+        self.reader_pool_size = reader_pool_size
+        self.reader_count = 0
+        self.reader_lock = threading.Lock()
+        self.group_commit_writer = None
+        self.group_commit_lock = threading.Lock()
+
+    def connect(self):
+        # Connections move between threads, but only one thread uses a connection at a time
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def reader(self):
+        with main_thread_io.watch(), self.read_connection() as conn:
+            yield conn
+
+    @contextmanager
+    def read_connection(self):
+        # A read connection for the duration of the block, waits if they are all in use
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.reader_lock:
+                create = self.reader_count < self.reader_pool_size
+                if create:
+                    self.reader_count += 1
+            conn = self.connect() if create else self.readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self.readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        # The write connection, committed at the end of the block or rolled back on error.
+        # Nested blocks on the same thread share the outer transaction.
+        with main_thread_io.watch(), self.write_lock:
+            if self.write_conn.in_transaction:
+                yield self.write_conn
+                return
+            try:
+                yield self.write_conn
+                self.write_conn.commit()
+            except BaseException:
+                self.write_conn.rollback()
+                raise
+
+    def fetchone(self, query, params=()):
+        with self.reader() as conn:
+            return conn.execute(query, params).fetchone()
+
+    def fetchall(self, query, params=()):
+        with self.reader() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def execute(self, query, params=()):
+        # Runs a write in its own transaction, the cursor gives lastrowid / rowcount
+        with self.writer() as conn:
+            return conn.execute(query, params)
+
+    def executemany(self, query, params):
+        with self.writer() as conn:
+            return conn.executemany(query, params)
+
+    def group_commit(self):
+        # The service's GroupCommitWriter, for writes that don't have to be visible right away
+        with self.group_commit_lock:
+            if self.group_commit_writer is None:
+                self.group_commit_writer = GroupCommitWriter(self)
+            return self.group_commit_writer
+
+
+class GroupCommitWriter:
+    # Queues single-row writes and commits them in one transaction with executemany, instead of
+    # one transaction per row. add() never touches the database; a background thread flushes
+    # once flush_rows writes are queued or the oldest has waited flush_delay seconds.
+    def __init__(self, db, flush_rows=GROUP_COMMIT_ROWS, flush_delay=GROUP_COMMIT_DELAY):
+        self.db = db
+        self.flush_rows = flush_rows
+        self.flush_delay = flush_delay
+        self.condition = threading.Condition()
+        # (query, params) in the order they were added, and when the first of them was
+        self.pending = []
+        self.oldest = None
+        # Held from taking the queue to committing it, so batches are written in order
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='group-commit', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def add(self, query, params=()):
+        with self.condition:
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending.append((query, params))
+            if len(self.pending) == 1 or len(self.pending) >= self.flush_rows:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                remaining = self.oldest + self.flush_delay - time.monotonic()
+                if len(self.pending) < self.flush_rows and remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+            self.flush()
+
+    def flush(self):
+        # Writes everything queued so far, returns the number of rows written
+        with self.flush_lock:
+            with self.condition:
+                rows, self.pending = self.pending, []
+            if not rows:
+                return 0
+            try:
+                with self.db.writer() as conn:
+                    # Consecutive writes of the same statement go in one executemany
+                    for query, group in groupby(rows, key=itemgetter(0)):
+                        conn.executemany(query, [params for _, params in group])
+            except sqlite3.Error as e:
+                logging.error(f"Group commit of {len(rows)} writes failed: {e}")
+                return 0
+            return len(rows)
+
+
+# One service per database file, shared by every manager
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_database_service(db_path='comments.db'):
+    with _services_lock:
+        if db_path not in _services:
+            _services[db_path] = DatabaseService(db_path)
+        return _services[db_path]
+
+
+if __name__ == '__main__':
+    # python database_service.py [rows]: message insert throughput, one commit per row vs batched
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # Running on the main thread is the point here, not worth a warning
+    logging.disable(logging.WARNING)
+    insert = "INSERT INTO messages (sender_id, receiver_id, message, timestamp, thread_id) VALUES (?, ?, ?, ?, ?)"
+    rows = [(1 + number % 2, 2 - number % 2, b'x' * 120, f'2024-01-01 00:00:{number % 60:02d}.{number:06d}', 1)
+            for number in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        service = DatabaseService(os.path.join(directory, 'benchmark.db'))
+
+        def timed(label, write):
+            start = time.perf_counter()
+            write()
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {count / elapsed:,.0f} rows/s")
+
+        def group_commit():
+            writer = GroupCommitWriter(service)
+            for row in rows:
+                writer.add(insert, row)
+            writer.flush()
+
+        timed("one commit per row", lambda: [service.execute(insert, row) for row in rows])
+        timed("executemany, one commit", lambda: service.executemany(insert, rows))
+        timed("group commit writer", group_commit)
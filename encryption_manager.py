@@ -1,6 +1,22 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 
 
+# Batches at least this big are decrypted on the decrypt pool instead of the calling thread.
+# Threads only help with cores to run them on, a single-core device always decrypts inline.
+PARALLEL_DECRYPT_MIN = 200
+DECRYPT_WORKERS = min(4, os.cpu_count() or 1)
+
+# Own pool: callers are often already on a background_tasks worker, waiting on jobs queued to
+# that same executor could deadlock it
+decrypt_executor = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix='decrypt')
+
+
 class EncryptionManager:
     def __init__(self, key):
         self.cipher_suite = Fernet(key)
@@ -13,3 +29,81 @@ class EncryptionManager:
         decrypted_message = self.cipher_suite.decrypt(encrypted_message).decode()
         return decrypted_message
 
+    def decrypt_messages(self, encrypted_messages, workers=None):
+        # Decrypts a list of ciphertexts, in order. Large batches are split in one chunk per worker.
+        if workers is None:
+            workers = DECRYPT_WORKERS if len(encrypted_messages) >= PARALLEL_DECRYPT_MIN else 1
+        if workers <= 1:
+            return [self.decrypt_message(message) for message in encrypted_messages]
+        chunk_size = -(-len(encrypted_messages) // workers)
+        chunks = [encrypted_messages[start:start + chunk_size]
+                  for start in range(0, len(encrypted_messages), chunk_size)]
+        executor = decrypt_executor if workers <= DECRYPT_WORKERS else ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = [executor.submit(self.decrypt_messages, chunk, 1) for chunk in chunks]
+            return [message for future in futures for message in future.result()]
+        finally:
+            if executor is not decrypt_executor:
+                executor.shutdown()
+
+
+class DecryptedMessageCache:
+    # Plaintext of recently shown messages, by message id. Memory only, never written anywhere.
+    # The ciphertext is kept with it and compared on lookup, so a message id reused after a
+    # delete can never show the old text.
+    def __init__(self, size=5000):
+        self.size = size
+        self.lock = threading.Lock()
+        # message id -> (ciphertext, plaintext), most recently used last
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def decrypt(self, encryption_manager, messages):
+        # messages: [(message_id, ciphertext)], returns their plaintexts in the same order
+        plaintexts = [None] * len(messages)
+        missing = []
+        with self.lock:
+            for index, (message_id, ciphertext) in enumerate(messages):
+                entry = self.entries.get(message_id)
+                if entry is not None and entry[0] == ciphertext:
+                    self.entries.move_to_end(message_id)
+                    plaintexts[index] = entry[1]
+                else:
+                    missing.append(index)
+            self.hits += len(messages) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            decrypted = encryption_manager.decrypt_messages([messages[index][1] for index in missing])
+            with self.lock:
+                for index, plaintext in zip(missing, decrypted):
+                    plaintexts[index] = plaintext
+                    self.entries[messages[index][0]] = (messages[index][1], plaintext)
+                    self.entries.move_to_end(messages[index][0])
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return plaintexts
+
+    def discard(self, message_id):
+        with self.lock:
+            self.entries.pop(message_id, None)
+
+
+if __name__ == '__main__':
+    # python encryption_manager.py [messages]: decrypt throughput by number of threads
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    manager = EncryptionManager(Fernet.generate_key())
+    ciphertexts = [manager.encrypt_message(f"Message number {number} " * 4) for number in range(count)]
+    print(f"{os.cpu_count()} CPU(s), {DECRYPT_WORKERS} decrypt worker(s) by default")
+    for workers in (1, 2, 4, 8):
+        start = time.perf_counter()
+        manager.decrypt_messages(ciphertexts, workers)
+        elapsed = time.perf_counter() - start
+        print(f"{workers} thread(s): {count / elapsed:,.0f} messages/s")
+    cache = DecryptedMessageCache(size=count)
+    messages = list(enumerate(ciphertexts))
+    for label in ('cold cache', 'warm cache'):
+        start = time.perf_counter()
+        cache.decrypt(manager, messages)
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {count / elapsed:,.0f} messages/s")
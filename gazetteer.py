@@ -0,0 +1,284 @@
+import csv
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+
+
+# Places file built from a GeoNames dump, next to comments.db
+GAZETTEER_PATH = 'gazetteer.db'
+
+# Prefixes up to this long have their best places precomputed, longer ones are a range scan of the
+# name index, narrow enough to rank on the fly
+TOP_PREFIX_LENGTH = 3
+TOP_PLACES = 10
+
+# Places written per transaction while importing
+IMPORT_BATCH = 5000
+
+# Columns of the GeoNames "geoname" TSV files (allCountries.txt, cities500.txt...)
+GEONAME_ID, NAME, ASCII_NAME, ALTERNATE_NAMES, LATITUDE, LONGITUDE, FEATURE_CLASS = range(7)
+COUNTRY_CODE, ADMIN1_CODE, POPULATION = 8, 10, 14
+
+
+def normalize_name(text):
+    # "Saint-Étienne " -> "saint etienne": no accents, no punctuation, lowercase
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+
+class Gazetteer:
+    # Offline place lookups: name prefixes for autocomplete and place names for geocoding, the
+    # most populated places first. Read-only while the app runs, one connection per thread.
+    # An import is built next to the file and moved over it once complete, readers never see a
+    # partial one; a damaged or outdated file still raises sqlite3.Error, callers treat it as a miss.
+    def __init__(self, path=GAZETTEER_PATH):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def available(self):
+        return os.path.exists(self.path)
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        return conn
+
+    def create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS places (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                display TEXT NOT NULL,
+                country TEXT,
+                country_name TEXT,
+                admin1 TEXT,
+                admin1_name TEXT,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                population INTEGER NOT NULL
+            )
+        """)
+        # Every normalized name of a place (name, ASCII name and optionally its alternate names)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS place_names (
+                key TEXT NOT NULL,
+                place_id INTEGER NOT NULL,
+                population INTEGER NOT NULL,
+                PRIMARY KEY (key, place_id)
+            ) WITHOUT ROWID
+        """)
+        # The TOP_PLACES most populated places of every short prefix
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS top_places (
+                prefix TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                place_id INTEGER NOT NULL,
+                PRIMARY KEY (prefix, rank)
+            ) WITHOUT ROWID
+        """)
+
+    def import_geonames(self, tsv_path, country_info_path=None, admin1_codes_path=None, feature_classes=('P',),
+                        min_population=0, alternate_names=False):
+        # Replaces the places with a GeoNames TSV dump (populated places by default). country_info_path
+        # is GeoNames' countryInfo.txt and admin1_codes_path its admin1CodesASCII.txt, for
+        # "Springfield, Illinois, United States" instead of "Springfield, IL, US". Returns the number of places.
+        country_names = read_country_names(country_info_path) if country_info_path else {}
+        admin1_names = read_admin1_names(admin1_codes_path) if admin1_codes_path else {}
+        # Own file per import, concurrent imports don't write into each other
+        handle, import_path = tempfile.mkstemp(suffix='.import', prefix=os.path.basename(self.path) + '.',
+                                               dir=os.path.dirname(os.path.abspath(self.path)))
+        os.close(handle)
+        conn = sqlite3.connect(import_path)
+        try:
+            # Nobody reads the file until it's complete, an interrupted import is just started again
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            self.create_tables(conn)
+            imported = 0
+            places = []
+            names = []
+            with open(tsv_path, encoding='utf-8', newline='') as tsv_file:
+                for row in csv.reader(tsv_file, delimiter='\t', quoting=csv.QUOTE_NONE):
+                    if len(row) <= POPULATION or (feature_classes and row[FEATURE_CLASS] not in feature_classes):
+                        continue
+                    population = int(row[POPULATION] or 0)
+                    if population < min_population:
+                        continue
+                    place_id = int(row[GEONAME_ID])
+                    country = row[COUNTRY_CODE]
+                    country_name = country_names.get(country, country)
+                    admin1 = row[ADMIN1_CODE]
+                    # Numeric admin1 codes ("FR.11") mean nothing to users, only show region names or codes like "TX"
+                    admin1_name = admin1_names.get(f"{country}.{admin1}",
+                                                   admin1 if admin1.isalpha() and admin1 != '00' else '')
+                    display = ', '.join(part for part in (row[NAME], admin1_name, country_name) if part)
+                    places.append((place_id, row[NAME], display, country, country_name, admin1, admin1_name,
+                                   float(row[LATITUDE]), float(row[LONGITUDE]), population))
+                    keys = {normalize_name(row[NAME]), normalize_name(row[ASCII_NAME])}
+                    if alternate_names:
+                        keys.update(normalize_name(name) for name in row[ALTERNATE_NAMES].split(','))
+                    names.extend((key, place_id, population) for key in keys if key)
+                    if len(places) >= IMPORT_BATCH:
+                        imported += self.write_places(conn, places, names)
+                        places, names = [], []
+            imported += self.write_places(conn, places, names)
+            self.build_top_places(conn)
+        except BaseException:
+            conn.close()
+            os.remove(import_path)
+            raise
+        conn.close()
+        # The journal of an older file would be replayed into the new one
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        os.replace(import_path, self.path)
+        return imported
+
+    def write_places(self, conn, places, names):
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", places)
+            conn.executemany("INSERT OR REPLACE INTO place_names (key, place_id, population) VALUES (?, ?, ?)",
+                             names)
+        return len(places)
+
+    def build_top_places(self, conn):
+        with conn:
+            conn.execute("DELETE FROM top_places")
+            for length in range(1, TOP_PREFIX_LENGTH + 1):
+                conn.execute("""
+                    INSERT INTO top_places (prefix, rank, place_id)
+                    SELECT prefix, rank, place_id FROM (
+                        SELECT prefix, place_id,
+                               ROW_NUMBER() OVER (PARTITION BY prefix ORDER BY population DESC, place_id) AS rank
+                        FROM (SELECT substr(key, 1, ?) AS prefix, place_id, MAX(population) AS population
+                              FROM place_names WHERE length(key) >= ? GROUP BY prefix, place_id)
+                    ) WHERE rank <= ?
+                """, (length, length, TOP_PLACES))
+            conn.execute("ANALYZE")
+
+    def suggest(self, text, limit=TOP_PLACES):
+        # Display names of the places whose name starts with text, most populated first.
+        # "paris, fr" only keeps the places of a country or region starting with "fr".
+        if not self.available:
+            return []
+        name, _, hint = text.partition(',')
+        key = normalize_name(name)
+        hint = normalize_name(hint)
+        if not key:
+            return []
+        conn = self.connection()
+        if len(key) <= TOP_PREFIX_LENGTH and not hint:
+            rows = conn.execute("""
+                SELECT places.display FROM top_places JOIN places ON places.id = top_places.place_id
+                WHERE top_places.prefix = ? ORDER BY top_places.rank LIMIT ?
+            """, (key, limit)).fetchall()
+            return [row[0] for row in rows]
+        rows = conn.execute("""
+            SELECT places.display, places.country, places.country_name, places.admin1, places.admin1_name
+            FROM place_names JOIN places ON places.id = place_names.place_id
+            WHERE place_names.key >= ? AND place_names.key < ?
+            GROUP BY places.id ORDER BY places.population DESC LIMIT ?
+        """, (key, key + '\U0010ffff', limit if not hint else limit * 20)).fetchall()
+        return [row[0] for row in rows if not hint or matches_place(hint, *row[1:], prefix=True)][:limit]
+
+    def geocode(self, location, loose=False):
+        # {'lat': ..., 'lng': ...} of a "place", "place, country" or "place, region, country" location, like
+        # OpenCage's geometry: everything after the place name has to be its country or region, otherwise
+        # it's an address only OpenCage can place. loose also tries the later parts of a longer address
+        # (offline fallback). None if nothing matches.
+        if not self.available:
+            return None
+        parts = [normalize_name(part) for part in (location or '').split(',')]
+        parts = [part for part in parts if part]
+        if not parts or (len(parts) > 3 and not loose):
+            return None
+        conn = self.connection()
+        for index in range(len(parts) if loose else 1):
+            # "41844 wegberg" -> "wegberg"
+            candidate = re.sub(r'^\d+\s+', '', parts[index])
+            hints = parts[index + 1:]
+            rows = conn.execute("""
+                SELECT places.lat, places.lon, places.country, places.country_name, places.admin1, places.admin1_name
+                FROM place_names JOIN places ON places.id = place_names.place_id
+                WHERE place_names.key = ? ORDER BY place_names.population DESC LIMIT 50
+            """, (candidate,)).fetchall()
+            for lat, lon, *place in rows:
+                if all(matches_place(hint, *place) for hint in hints):
+                    return {'lat': lat, 'lng': lon}
+        return None
+
+
+def matches_place(hint, country, country_name, admin1, admin1_name, prefix=False):
+    # hint: normalized text after the place name, the code or name of its country or region
+    # ("fr", "france", "tx", "texas"). prefix also accepts the start of a name, for text being typed.
+    if hint in (normalize_name(country), normalize_name(admin1)):
+        return True
+    names = (normalize_name(country_name), normalize_name(admin1_name))
+    return any(name and (name.startswith(hint) if prefix else name == hint) for name in names)
+
+
+def read_country_names(path):
+    # ISO code -> country name from GeoNames' countryInfo.txt
+    names = {}
+    with open(path, encoding='utf-8') as info_file:
+        for line in info_file:
+            if line.startswith('#'):
+                continue
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) > 4:
+                names[columns[0]] = columns[4]
+    return names
+
+
+def read_admin1_names(path):
+    # "US.IL" -> "Illinois" from GeoNames' admin1CodesASCII.txt
+    names = {}
+    with open(path, encoding='utf-8') as codes_file:
+        for line in codes_file:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) > 1:
+                names[columns[0]] = columns[1]
+    return names
+
+
+# One gazetteer per file, shared by the geocoder and the suggestions
+_gazetteers = {}
+_gazetteers_lock = threading.Lock()
+
+
+def get_gazetteer(path=GAZETTEER_PATH):
+    with _gazetteers_lock:
+        if path not in _gazetteers:
+            _gazetteers[path] = Gazetteer(path)
+        return _gazetteers[path]
+
+
+if __name__ == '__main__':
+    # python gazetteer.py cities500.txt [countryInfo.txt [admin1CodesASCII.txt]]: builds gazetteer.db and
+    # times lookups
+    if len(sys.argv) < 2:
+        print("usage: python gazetteer.py <geonames tsv> [countryInfo.txt [admin1CodesASCII.txt]]")
+        sys.exit(1)
+    gazetteer = Gazetteer()
+    start = time.perf_counter()
+    imported = gazetteer.import_geonames(*sys.argv[1:4])
+    print(f"Imported {imported} places in {time.perf_counter() - start:.1f} s")
+    for query in ('p', 'par', 'paris', 'paris, fr', 'san fr', 'new y'):
+        start = time.perf_counter()
+        for _ in range(1000):
+            results = gazetteer.suggest(query)
+        print(f"suggest {query!r}: {(time.perf_counter() - start) * 1000:.0f} us, {results[:3]}")
+    for query in ('Paris', 'Paris, France', 'Paris, TX', 'London, GB'):
+        start = time.perf_counter()
+        for _ in range(1000):
+            coordinates = gazetteer.geocode(query)
+        print(f"geocode {query!r}: {(time.perf_counter() - start) * 1000:.0f} us, {coordinates}")
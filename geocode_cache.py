@@ -0,0 +1,131 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from database_service import get_database_service
+
+
+# How long a geocoded location stays valid (found / not found), in seconds
+POSITIVE_TTL = 30 * 24 * 60 * 60
+NEGATIVE_TTL = 24 * 60 * 60
+
+# Maximum number of entries kept in memory and on disk
+MEMORY_SIZE = 2000
+DISK_SIZE = 50000
+
+# Only check the size of the disk table every N writes
+PRUNE_EVERY = 100
+
+
+def normalize_location(location):
+    # "  Paris,  France " and "paris, france" share the same cache entry
+    if not location:
+        return ''
+    location = re.sub(r'\s+', ' ', location).strip().lower()
+    return location.strip(' ,;')
+
+
+class GeocodeCache:
+    # OpenCage answers in memory (LRU) and in the geocode_cache table (created by the migrations).
+    # The lock only guards the in-memory entries, database reads and writes happen outside it.
+    def __init__(self, db_path, memory_size=MEMORY_SIZE, disk_size=DISK_SIZE,
+                 positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # query -> (coordinates or None, expires_at), most recently used last
+        self.memory = OrderedDict()
+        self.writes = 0
+        self.db = get_database_service(db_path)
+
+    def get(self, location):
+        # Returns (found, coordinates). A cached "not found" is (True, None).
+        query = normalize_location(location)
+        if not query:
+            return True, None
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(query)
+            if entry is not None:
+                if entry[1] > now:
+                    self.memory.move_to_end(query)
+                    return True, entry[0]
+                del self.memory[query]
+
+        row = self.db.fetchone("SELECT lat, lon, expires_at FROM geocode_cache WHERE query = ?", (query,))
+        if row is None:
+            return False, None
+        lat, lon, expires_at = row
+        if expires_at <= now:
+            self.db.execute("DELETE FROM geocode_cache WHERE query = ? AND expires_at <= ?", (query, now))
+            return False, None
+        # Touch the row so the disk LRU keeps it, committed with the other touches
+        self.db.group_commit().add("UPDATE geocode_cache SET last_used = ? WHERE query = ?", (now, query))
+        coordinates = {'lat': lat, 'lng': lon} if lat is not None else None
+        with self.lock:
+            self.remember(query, coordinates, expires_at)
+        return True, coordinates
+
+    def put(self, location, coordinates):
+        # coordinates is the OpenCage geometry dict, or None for "not found"
+        query = normalize_location(location)
+        if not query:
+            return
+        now = time.time()
+        if coordinates:
+            coordinates = {'lat': coordinates['lat'], 'lng': coordinates['lng']}
+            expires_at = now + self.positive_ttl
+            lat, lon = coordinates['lat'], coordinates['lng']
+        else:
+            coordinates = None
+            expires_at = now + self.negative_ttl
+            lat = lon = None
+        with self.lock:
+            self.remember(query, coordinates, expires_at)
+            self.writes += 1
+            prune = self.writes % PRUNE_EVERY == 0
+        self.db.execute(
+            "INSERT OR REPLACE INTO geocode_cache (query, lat, lon, expires_at, last_used) VALUES (?, ?, ?, ?, ?)",
+            (query, lat, lon, expires_at, now))
+        if prune:
+            self.prune()
+
+    def remember(self, query, coordinates, expires_at):
+        # Called with self.lock held
+        self.memory[query] = (coordinates, expires_at)
+        self.memory.move_to_end(query)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def prune(self):
+        # Drop expired rows, then the least recently used ones above the size limit
+        with self.db.writer() as conn:
+            conn.execute("DELETE FROM geocode_cache WHERE expires_at <= ?", (time.time(),))
+            count = conn.execute("SELECT COUNT(*) FROM geocode_cache").fetchone()[0]
+            if count > self.disk_size:
+                conn.execute("""
+                    DELETE FROM geocode_cache WHERE query IN (
+                        SELECT query FROM geocode_cache ORDER BY last_used ASC LIMIT ?
+                    )
+                """, (count - self.disk_size,))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        self.db.execute("DELETE FROM geocode_cache")
+
+
+# One cache per database file, shared by every APIManager
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_geocode_cache(db_path='comments.db'):
+    with _caches_lock:
+        if db_path not in _caches:
+            _caches[db_path] = GeocodeCache(db_path)
+        return _caches[db_path]
@@ -14,6 +14,9 @@ from kivy.uix.screenmanager import Screen
 from kivy.core.window import Window
 from kivy.uix.textinput import TextInput
 import sqlite3
+import logging
+import threading
+import time
 from kivy.uix.widget import Widget
 from kivy_garden.mapview import MapView
 from kivy.clock import Clock
@@ -25,7 +28,18 @@ from kivy.uix.spinner import Spinner
 from bcrypt import gensalt, hashpw
 from kivy.uix.image import Image
 from comments_manager import CommentManager, CommentMarker, MessageManager
+from marker_clusters import ClusterIndex, ClusterMarker, MAX_CLUSTER_ZOOM, bounds_center, fit_zoom, points_bounds
+from background_tasks import BackgroundTask, database_worker
+from comment_search import fts_query, private_comment_index
+from collections import deque
 from encryption_manager import EncryptionManager
+from geocode_cache import get_geocode_cache
+from gazetteer import get_gazetteer
+from tile_store import PackedMapSource, TilePrefetcher, get_tile_store
+from suggestion_service import MAX_SUGGESTIONS, get_suggestion_service
+from database_service import get_database_service
+from user_directory import get_user_directory
+from message_queries import MARK_CONVERSATION_READ, THREAD_ID_FOR_PAIR, USER_CONVERSATIONS, USER_THREAD_IDS, pair_params
 
 
 # Set the icon of the app
@@ -50,8 +64,7 @@ g = int(color[3:5], 16) / 255
 b = int(color[5:7], 16) / 255
 
 your_api_key = os.getenv("API-KEY")
-conn = sqlite3.connect('comments.db')
-c = conn.cursor()
+db_service = get_database_service('comments.db')
 
 
 # Get the key from the environment variable
@@ -62,6 +75,34 @@ encryption_manager = EncryptionManager(key)
 
 kivy.require('2.1.0')
 
+# Columns returned for a comment by DatabaseManager
+COMMENT_COLUMNS = ("id, user_id, topic, comment, location, is_encrypted, is_anonymous, anonymous_username, username, "
+                   "timestamp, lat, lon")
+
+# Most markers the map shows for one viewport, and how long to wait after a pan/zoom before reloading them
+MAX_VIEWPORT_MARKERS = 300
+VIEWPORT_RELOAD_DELAY = 0.3
+
+# Fitting the map to the comments: the closest it zooms in (a single comment shouldn't fill the
+# screen), the margin kept around them in pixels, and the fraction of outlying comments left out
+MAX_FIT_ZOOM = 15
+FIT_PADDING = 40
+FIT_TRIM = 0.02
+
+# How long to wait after a pan/zoom before prefetching the map tiles around the view
+TILE_PREFETCH_DELAY = 0.2
+
+# Comments sent back to the map per batch by the loading thread, and markers created per frame
+MARKER_BATCH_SIZE = 50
+MARKERS_PER_FRAME = 20
+
+# Search results loaded at a time, and how many results before/after the current one get geocoded ahead
+SEARCH_PAGE_SIZE = 20
+SEARCH_PREFETCH = 3
+
+# How long the location input waits after the last keystroke before asking the remote service
+SUGGESTION_DELAY = 0.4
+
 
 class RoundedButton(ButtonBehavior, Label):
     def __init__(self, **kwargs):
@@ -78,147 +119,347 @@ class RoundedButton(ButtonBehavior, Label):
         self.rect.size = self.size
 
 
+# Comments getting their first coordinates aren't logged in comment_changes (a backfill would flood
+# it), they're only counted: the map reads every point again when the count moved
+_geocoded_comments = 0
+_geocoded_comments_lock = threading.Lock()
+
+
+def count_geocoded_comments(count):
+    global _geocoded_comments
+    with _geocoded_comments_lock:
+        _geocoded_comments += count
+
+
+def geocoded_comments():
+    with _geocoded_comments_lock:
+        return _geocoded_comments
+
+
 class DatabaseManager:
     def __init__(self, db_comments):
         self.db_comments = db_comments
-        self.conn = sqlite3.connect(self.db_comments)
+        # Connections are owned by the shared service, every DatabaseManager of a file uses the same ones
+        self.db = get_database_service(self.db_comments)
+        # id <-> username lookups, cached for the whole process
+        self.users = get_user_directory(self.db_comments)
 
-    def insert_comment(self, user_id, topic, comment, location, is_private, is_anonymous):
-        cursor = self.conn.cursor()
+    def insert_comment(self, user_id, topic, comment, location, is_private, is_anonymous, lat=None, lon=None):
+        self.insert_comments_bulk([(user_id, topic, comment, location, is_private, is_anonymous, lat, lon)])
+
+    def insert_comments_bulk(self, comments):
+        # comments: (user_id, topic, comment, location, is_private, is_anonymous[, lat, lon]) tuples,
+        # all inserted in one transaction. Returns the number of comments inserted.
         timestamp = datetime.now().strftime('%d/%m/%y %H:%M')
-        is_encrypted = 0
-        if is_private:
-            # Encryption using EncryptionManager
-            comment = encryption_manager.encrypt_message(comment)
-            is_encrypted = 1
-        if is_anonymous:
-            username = 'Anonymous'
-        else:
-            # Fetch the actual username from the users table
-            cursor.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-            username = cursor.fetchone()[0]
-        cursor.execute(
-            "INSERT INTO comments (user_id, topic, comment, location, is_private, is_encrypted, is_anonymous, username, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, topic, comment, location, is_private, is_encrypted, is_anonymous, username, timestamp))
-        self.conn.commit()
+        rows = []
+        for user_id, topic, comment, location, is_private, is_anonymous, *coordinates in comments:
+            lat, lon = coordinates if coordinates else (None, None)
+            is_encrypted = 0
+            if is_private:
+                # Encryption using EncryptionManager
+                comment = encryption_manager.encrypt_message(comment)
+                is_encrypted = 1
+            # The actual username from the users table, looked up once per user of the batch
+            username = 'Anonymous' if is_anonymous else self.users.username(user_id)
+            rows.append((user_id, topic, comment, location, is_private, is_encrypted, is_anonymous, username, timestamp,
+                         lat, lon))
+        self.db.executemany(
+            "INSERT INTO comments (user_id, topic, comment, location, is_private, is_encrypted, is_anonymous, username, timestamp, lat, lon) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+        return len(rows)
 
     def get_comments(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT id, user_id, topic, comment, location, is_encrypted, is_anonymous, anonymous_username, username, timestamp FROM comments WHERE is_private = 0 OR user_id = ?",
+        rows = self.db.fetchall(
+            f"SELECT {COMMENT_COLUMNS} FROM comments WHERE is_private = 0 OR user_id = ?",
             (user_id,))
-        comments = cursor.fetchall()
+        return self.decrypt_comments(rows)
+
+    def get_comments_in_bbox(self, user_id, lat_min, lon_min, lat_max, lon_max, limit=MAX_VIEWPORT_MARKERS):
+        # Only the comments inside the bounding box, found through the comments_rtree index
+        columns = ', '.join(f"comments.{column}" for column in COMMENT_COLUMNS.split(', '))
+        rows = self.db.fetchall(f"""
+            SELECT {columns} FROM comments_rtree
+            JOIN comments ON comments.id = comments_rtree.id
+            WHERE comments_rtree.max_lat >= ? AND comments_rtree.min_lat <= ?
+              AND comments_rtree.max_lon >= ? AND comments_rtree.min_lon <= ?
+              AND (comments.is_private = 0 OR comments.user_id = ?)
+            ORDER BY comments.id DESC
+            LIMIT ?
+        """, (min(lat_min, lat_max), max(lat_min, lat_max), min(lon_min, lon_max), max(lon_min, lon_max),
+              user_id, limit))
+        return self.decrypt_comments(rows)
+
+    def get_comment_points(self, user_id, after_id=0, up_to_id=None, comment_ids=None):
+        # Just what the clustering needs, no decryption
+        query = """
+            SELECT id, topic, lat, lon FROM comments
+            WHERE lat IS NOT NULL AND lon IS NOT NULL AND (is_private = 0 OR user_id = ?) AND id > ?
+        """
+        params = [user_id, after_id]
+        if up_to_id is not None:
+            query += " AND id <= ?"
+            params.append(up_to_id)
+        if comment_ids is not None:
+            comment_ids = list(comment_ids)
+            if not comment_ids:
+                return []
+            query += f" AND id IN ({', '.join('?' * len(comment_ids))})"
+            params.extend(comment_ids)
+        return self.db.fetchall(query, params)
+
+    def get_last_comment_id(self):
+        return self.db.fetchone("SELECT MAX(id) FROM comments")[0] or 0
+
+    def get_last_change_seq(self):
+        return self.db.fetchone("SELECT MAX(seq) FROM comment_changes")[0] or 0
+
+    def get_comment_changes(self, since_seq):
+        # Ids of the comments updated or deleted after since_seq, and the new last seq.
+        # The ids are None if some of those changes were pruned already (see prune_comment_changes).
+        rows = self.db.fetchall("SELECT seq, comment_id FROM comment_changes WHERE seq > ? ORDER BY seq", (since_seq,))
+        if not rows:
+            return since_seq, set()
+        # seq is AUTOINCREMENT, a hole right after since_seq is a pruned change
+        if rows[0][0] > since_seq + 1:
+            return rows[-1][0], None
+        return rows[-1][0], {comment_id for seq, comment_id in rows}
+
+    def prune_comment_changes(self, up_to_seq):
+        # Database thread: forgets the changes up to up_to_seq that the private search indexes have
+        # applied too, but the latest one (get_last_change_seq reads it). A reader that still needed
+        # them (another app instance) reads everything again.
+        oldest_seq = private_comment_index.oldest_seq()
+        if oldest_seq is not None:
+            up_to_seq = min(up_to_seq, oldest_seq)
+        return self.db.execute("DELETE FROM comment_changes WHERE seq <= ? AND seq < (SELECT MAX(seq) FROM comment_changes)",
+                               (up_to_seq,)).rowcount
+
+    def get_comments_by_ids(self, user_id, comment_ids):
+        comment_ids = list(comment_ids)
+        if not comment_ids:
+            return []
+        placeholders = ', '.join('?' * len(comment_ids))
+        rows = self.db.fetchall(
+            f"SELECT {COMMENT_COLUMNS} FROM comments WHERE id IN ({placeholders}) AND (is_private = 0 OR user_id = ?)",
+            (*comment_ids, user_id))
+        return self.decrypt_comments(rows)
+
+    def search_comments(self, user_id, search_text, limit=SEARCH_PAGE_SIZE, offset=0):
+        # The user's own private comments that match come first (from the in-memory index),
+        # then the public ones ranked by the FTS index
+        private_results = self.search_private_comments(user_id, search_text)
+        results = private_results[offset:offset + limit]
+        query = fts_query(search_text)
+        if query is None or len(results) == limit:
+            return results
+        columns = ', '.join(f"comments.{column}" for column in COMMENT_COLUMNS.split(', '))
+        return results + self.db.fetchall(f"""
+            SELECT {columns} FROM comments_fts
+            JOIN comments ON comments.id = comments_fts.rowid
+            WHERE comments_fts MATCH ? AND (comments.is_private = 0 OR comments.user_id = ?)
+            ORDER BY bm25(comments_fts)
+            LIMIT ? OFFSET ?
+        """, (query, user_id, limit - len(results), max(0, offset - len(private_results))))
+
+    def search_private_comments(self, user_id, search_text):
+        with private_comment_index.lock:
+            # Only decrypt what was added or changed since the index was last used
+            state = private_comment_index.get_state(user_id)
+            if state is None:
+                last_id, (last_seq, changed_ids) = 0, (self.get_last_change_seq(), set())
+            else:
+                last_id, last_seq = state
+                last_seq, changed_ids = self.get_comment_changes(last_seq)
+                if changed_ids is None:
+                    # Missed changes: the user's index is filled again from scratch
+                    private_comment_index.reset(user_id)
+                    last_id, changed_ids = 0, set()
+            with self.db.reader() as conn:
+                rows = conn.execute(
+                    f"SELECT {COMMENT_COLUMNS} FROM comments WHERE user_id = ? AND is_encrypted = 1 AND id > ?",
+                    (user_id, last_id)).fetchall()
+                if changed_ids:
+                    placeholders = ', '.join('?' * len(changed_ids))
+                    rows += conn.execute(f"SELECT {COMMENT_COLUMNS} FROM comments "
+                                         f"WHERE user_id = ? AND is_encrypted = 1 AND id <= ? AND id IN ({placeholders})",
+                                         (user_id, last_id, *changed_ids)).fetchall()
+            new_last_id = max([last_id] + [row[0] for row in rows])
+            private_comment_index.update(user_id, self.decrypt_comments(rows), changed_ids, new_last_id, last_seq)
+            return private_comment_index.search(user_id, search_text)
+
+    def decrypt_comments(self, comments):
         decrypted_comments = []
         for comment in comments:
             if comment[5]:  # If the comment is encrypted
                 # Decryption using EncryptionManager
                 decrypted_comment = encryption_manager.decrypt_message(comment[3])
-                comment = (
-                    comment[0], comment[1], comment[2], decrypted_comment, comment[4], comment[5], comment[6],
-                    comment[7], comment[8])
+                comment = comment[:3] + (decrypted_comment,) + comment[4:]
             decrypted_comments.append(comment)
         return decrypted_comments
 
+    def update_comment_coordinates(self, comment_id, lat, lon):
+        self.db.execute("UPDATE comments SET lat = ?, lon = ? WHERE id = ?", (lat, lon, comment_id))
+        count_geocoded_comments(1)
+
+    def backfill_coordinates(self, api_manager, batch_size=50):
+        # Geocode the comments saved before lat/lon existed, one batch at a time.
+        # Locations that can't be geocoded stay NULL (the geocode cache remembers them).
+        last_id = 0
+        filled = 0
+        while True:
+            rows = self.db.fetchall("SELECT id, location FROM comments WHERE lat IS NULL AND id > ? ORDER BY id LIMIT ?",
+                                    (last_id, batch_size))
+            if not rows:
+                break
+            updates = []
+            for comment_id, location in rows:
+                last_id = comment_id
+                try:
+                    lat_lng = api_manager.get_location_coordinates(location)
+                except Exception as e:
+                    # Whatever went wrong (network, unexpected answer, gazetteer file), the other comments
+                    # still get geocoded and this one is tried again on the next run
+                    logging.error(f"Failed to geocode comment {comment_id}: {e}")
+                    continue
+                if lat_lng:
+                    updates.append((lat_lng['lat'], lat_lng['lng'], comment_id))
+            self.db.executemany("UPDATE comments SET lat = ?, lon = ? WHERE id = ?", updates)
+            count_geocoded_comments(len(updates))
+            filled += len(updates)
+        return filled
+
     def update_user(self, user_id, new_username, new_password):
-        cursor = self.conn.cursor()
+        with self.db.writer() as conn:
+            if new_username is not None:
+                conn.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
+                conn.execute("UPDATE comments SET anonymous_username = ? WHERE user_id = ? AND is_anonymous = 1",
+                             (new_username, user_id))
+            if new_password is not None:
+                conn.execute("UPDATE users SET password = ? WHERE id = ?", (new_password, user_id))
         if new_username is not None:
-            cursor.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
-            cursor.execute("UPDATE comments SET anonymous_username = ? WHERE user_id = ? AND is_anonymous = 1",
-                           (new_username, user_id))
-        if new_password is not None:
-            cursor.execute("UPDATE users SET password = ? WHERE id = ?", (new_password, user_id))
-        self.conn.commit()
+            self.users.forget(user_id)
 
     def delete_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM comments WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        self.conn.commit()
+        with self.db.writer() as conn:
+            conn.execute("DELETE FROM comments WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        self.users.forget(user_id)
 
     def update_privacy_mode(self, user_id, is_private):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE comments SET is_private = ? WHERE id = ?", (is_private, user_id))
-        self.conn.commit()
+        self.db.execute("UPDATE comments SET is_private = ? WHERE id = ?", (is_private, user_id))
 
     def get_users(self, current_user_id):
-        with sqlite3.connect(self.db_comments) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT DISTINCT users.id, users.username FROM users
-                JOIN messages ON users.id = messages.sender_id OR users.id = messages.receiver_id
-                WHERE (messages.sender_id = ? OR messages.receiver_id = ?) AND users.id != ?
-            """, (current_user_id, current_user_id, current_user_id,))
-            users = cursor.fetchall()
-            return users
+        # Users current_user_id has exchanged messages with
+        return [(partner_id, username) for partner_id, username, *_ in self.get_conversations(current_user_id)]
+
+    def get_conversations(self, user_id, limit=None):
+        # (partner_id, username, thread_id, last_message_at, unread_count), most recent first.
+        # Read from the conversations table the messages triggers maintain, never from messages.
+        conversations = self.db.fetchall(USER_CONVERSATIONS, (user_id, -1 if limit is None else limit))
+        for partner_id, username, *_ in conversations:
+            self.users.remember(partner_id, username)
+        return conversations
+
+    def mark_conversation_read(self, user_id, partner_id):
+        self.db.execute(MARK_CONVERSATION_READ, (user_id, partner_id))
 
     def get_thread_id(self, user1_id, user2_id):
-        with sqlite3.connect(self.db_comments) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT thread_id FROM messages 
-                WHERE (sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (user1_id, user2_id, user2_id, user1_id))
-            thread_id = cursor.fetchone()
-            return thread_id[0] if thread_id else None
-
-    def create_new_thread_id(self):
-        with sqlite3.connect(self.db_comments) as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO threads DEFAULT VALUES")
-            new_thread_id = cursor.lastrowid
-            conn.commit()
-            return new_thread_id
+        # None if these users never opened a chat together
+        thread_id = self.db.fetchone(THREAD_ID_FOR_PAIR, pair_params(user1_id, user2_id))
+        return thread_id[0] if thread_id else None
+
+    def get_or_create_thread_id(self, user1_id, user2_id):
+        # The one thread of this pair of users, created the first time they open a chat
+        thread_id = self.get_thread_id(user1_id, user2_id)
+        if thread_id is not None:
+            return thread_id
+        try:
+            with self.db.writer() as conn:
+                # Check again now that writes are serialized, another thread may have just created it
+                row = conn.execute(THREAD_ID_FOR_PAIR, pair_params(user1_id, user2_id)).fetchone()
+                if row:
+                    return row[0]
+                thread_id = conn.execute("INSERT INTO threads DEFAULT VALUES").lastrowid
+                conn.execute("INSERT INTO thread_participants (thread_id, user_lo, user_hi) VALUES (?, ?, ?)",
+                             (thread_id, min(user1_id, user2_id), max(user1_id, user2_id)))
+        except sqlite3.IntegrityError:
+            # Created by another instance of the app in the meantime, use that one
+            return self.get_thread_id(user1_id, user2_id)
+        return thread_id
 
     def get_thread_ids(self, user_id):
-        with sqlite3.connect(self.db_comments) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT DISTINCT thread_id FROM messages
-                WHERE sender_id = ? OR receiver_id = ?
-            """, (user_id, user_id,))
-            thread_ids = [row[0] for row in cursor.fetchall()]
-            return thread_ids
+        return [row[0] for row in self.db.fetchall(USER_THREAD_IDS, (user_id, user_id))]
 
     def fetch_user_id(self, username):
-        with sqlite3.connect(self.db_comments) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user_ids = cursor.fetchone()
-            if user_ids is not None:
-                user_id = user_ids[0]
-                return user_id
-            else:
-                return None
+        return self.users.user_id(username)
 
     def fetch_username(self, user_id):
-        with sqlite3.connect(self.db_comments) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-            usernames = cursor.fetchone()
-            if usernames is not None:
-                username = usernames[0]
-                return username
+        return self.users.username(user_id)
 
     def fetch_key(self):
         key = os.getenv("ENCRYPTION_KEY")
         return key.encode()
 
     def close(self):
-        self.conn.close()
+        # The connections belong to the shared DatabaseService and stay open
+        pass
+
+
+def start_coordinate_backfill(db_path='comments.db'):
+    def run():
+        db_manager = DatabaseManager(db_path)
+        try:
+            filled = db_manager.backfill_coordinates(APIManager(your_api_key, db_path))
+            logging.info(f"Backfilled coordinates of {filled} comments")
+        finally:
+            db_manager.close()
+
+    thread = threading.Thread(target=run, name='coordinate-backfill', daemon=True)
+    thread.start()
+    return thread
 
 
 class APIManager:
-    def __init__(self, api_key):
+    def __init__(self, api_key, db_path='comments.db'):
         self.api_key = api_key
+        # The cache is shared by every APIManager using the same database
+        self.geocode_cache = get_geocode_cache(db_path)
+        self.gazetteer = get_gazetteer()
 
     def get_location_coordinates(self, location):
+        found, coordinates = self.geocode_cache.get(location)
+        if found:
+            return coordinates
+        # "City" or "City, Country" is answered by the local gazetteer, full addresses go to OpenCage
+        coordinates = self.local_coordinates(location)
+        if coordinates:
+            self.geocode_cache.put(location, coordinates)
+            return coordinates
         url = f'https://api.opencagedata.com/geocode/v1/json?q={location}&key={self.api_key}'
-        response = requests.get(url)
+        try:
+            response = requests.get(url, timeout=10)
+        except requests.RequestException:
+            # Offline: the place of the address the gazetteer knows, not cached so OpenCage can do better later
+            coordinates = self.local_coordinates(location, loose=True)
+            if coordinates:
+                return coordinates
+            raise
         data = response.json()
+        coordinates = None
         if 'results' in data and data['results']:
-            return data['results'][0]['geometry']
+            coordinates = data['results'][0]['geometry']
+        # Don't cache errors (bad key, quota exceeded...) as "not found"
+        if coordinates or response.status_code == 200:
+            self.geocode_cache.put(location, coordinates)
+        return coordinates
+
+    def local_coordinates(self, location, loose=False):
+        # The gazetteer's answer, None on a miss or if its file can't be read
+        try:
+            return self.gazetteer.geocode(location, loose)
+        except sqlite3.Error as e:
+            logging.error(f"Gazetteer lookup failed for location '{location}': {e}")
+            return None
 
 
 class BaseScreen(Screen):
@@ -347,36 +588,41 @@ class LoginScreen(BaseScreen):
             self.error_label.text = "Please enter a username and password"
             return
 
-        c.execute('''SELECT * FROM users WHERE username = ?''', (username,))
-        user = c.fetchone()
-        if user is not None:
-            # The username exists, now we check the password
-            stored_password = user[2]  # assuming 'password' is the third column
-            stored_password = binascii.unhexlify(stored_password.encode('utf-8'))
-
-            # Hash the input password with the stored hashed password (which includes the salt)
-            hashed_password = hashpw(password.encode('utf-8'), stored_password)
-
-            if hashed_password == stored_password:
-                user_id = user[0]  # Store the user ID
-                username = user[1]  # Store the username
-                key = os.getenv("ENCRYPTION_KEY").encode()
-                # Set the logged_in status to 1 for the current user
-                self.message_manager = MessageManager(user_id, username, key)
-                c.execute("UPDATE users SET logged_in = 1 WHERE id = ?", (user_id,))
-                conn.commit()
-                app = App.get_running_app()
-                app.user_id = user_id
-                app.username = username
-                app.key = key
-                app.on_login_success(user_id, username, key)
-                self.screen_manager.current = 'main'
-            else:
-                # The password is incorrect
-                self.error_label.text = "Incorrect username or password"
-        else:
+        # The lookup and the (slow on purpose) bcrypt check run on the database thread
+        database_worker.submit(self.check_credentials, username, password, on_done=self.on_credentials_checked)
+
+    def check_credentials(self, username, password):
+        # Database thread: (user_id, username) if the password is right, None otherwise
+        user = db_service.fetchone('''SELECT * FROM users WHERE username = ?''', (username,))
+        if user is None:
             # The username does not exist
+            return None
+        # The username exists, now we check the password
+        stored_password = user[2]  # assuming 'password' is the third column
+        stored_password = binascii.unhexlify(stored_password.encode('utf-8'))
+
+        # Hash the input password with the stored hashed password (which includes the salt)
+        hashed_password = hashpw(password.encode('utf-8'), stored_password)
+        if hashed_password != stored_password:
+            # The password is incorrect
+            return None
+        # Set the logged_in status to 1 for the current user
+        db_service.execute("UPDATE users SET logged_in = 1 WHERE id = ?", (user[0],))
+        return user[0], user[1]
+
+    def on_credentials_checked(self, user):
+        if user is None:
             self.error_label.text = "Incorrect username or password"
+            return
+        user_id, username = user
+        key = os.getenv("ENCRYPTION_KEY").encode()
+        self.message_manager = MessageManager(user_id, username, key)
+        app = App.get_running_app()
+        app.user_id = user_id
+        app.username = username
+        app.key = key
+        app.on_login_success(user_id, username, key)
+        self.screen_manager.current = 'main'
 
     def sign_up(self, instance):
         self.confirm_password.opacity = 1  # Make the confirmed password field visible
@@ -385,42 +631,44 @@ class LoginScreen(BaseScreen):
         confirm_password = self.confirm_password.text
         if username and password:  # Check if both fields are not empty
             if password == confirm_password:
-                # Generate a unique salt for each user
-                salt = gensalt()
+                database_worker.submit(self.create_user, username, password, on_done=self.on_user_created)
+            else:
+                self.error_label.text = "Passwords do not match. Try again."
 
-                # Hash the password with the salt
-                hashed_password = hashpw(password.encode('utf-8'), salt)
+    def create_user(self, username, password):
+        # Database thread: hash the password and insert the user, returns the new user id
+        # Generate a unique salt for each user
+        salt = gensalt()
 
-                hashed_password = binascii.hexlify(hashed_password).decode('utf-8')
+        # Hash the password with the salt
+        hashed_password = hashpw(password.encode('utf-8'), salt)
 
-                c.execute('''SELECT COUNT(*) FROM users''')
-                user_count = c.fetchone()[0]
+        hashed_password = binascii.hexlify(hashed_password).decode('utf-8')
 
-                if user_count == 0:
-                    # If there are no existing users, make this user an admin
-                    c.execute('''INSERT INTO users (username, password, admin) VALUES (?, ?, 1)''',
-                              (username, hashed_password))
-                else:
-                    c.execute('''INSERT INTO users (username, password) VALUES (?, ?)''', (username, hashed_password))
+        with db_service.writer() as conn:
+            user_count = conn.execute('''SELECT COUNT(*) FROM users''').fetchone()[0]
 
-                conn.commit()
-                # After inserting the new user into the database
-                c.execute('''SELECT id FROM users WHERE username = ?''', (username,))
-                user_id = c.fetchone()[0]
+            if user_count == 0:
+                # If there are no existing users, make this user an admin
+                conn.execute('''INSERT INTO users (username, password, admin) VALUES (?, ?, 1)''',
+                             (username, hashed_password))
+            else:
+                conn.execute('''INSERT INTO users (username, password) VALUES (?, ?)''', (username, hashed_password))
 
-                # Set the user_id in your MyApp instance
-                App.get_running_app().user_id = user_id
+            # After inserting the new user into the database
+            return conn.execute('''SELECT id FROM users WHERE username = ?''', (username,)).fetchone()[0]
 
-                self.manager.current = 'main'  # Switch to the main screen
-            else:
-                self.error_label.text = "Passwords do not match. Try again."
+    def on_user_created(self, user_id):
+        # Set the user_id in your MyApp instance
+        App.get_running_app().user_id = user_id
+
+        self.manager.current = 'main'  # Switch to the main screen
 
     def new_session(self):
         # Get the current user's id
         user_id = App.get_running_app().user_id
         # Set the logged_in status to 0 for the current user
-        c.execute("UPDATE users SET logged_in = 0 WHERE id = ?", (user_id,))
-        conn.commit()
+        database_worker.submit(db_service.execute, "UPDATE users SET logged_in = 0 WHERE id = ?", (user_id,))
         # Clear the username and password fields
         self.username.text = ""
         self.password.text = ""
@@ -518,17 +766,22 @@ class AutocompleteTextInput(TextInput):
     def __init__(self, dropdown_parent=None, **kwargs):
         super(AutocompleteTextInput, self).__init__(**kwargs)
         self.api_manager = APIManager('your_api_key')
+        self.suggestion_service = get_suggestion_service(your_api_key)
         self.dropdown = DropDown(max_height=200, size_hint=(1, None), height=60)
         self.dropdown_parent = dropdown_parent
         self.dropdown.background_color = [1, 0, 0, 1]  # Set to red for visibility
+        # The suggestion buttons, created once and reused for every answer
+        self.suggestion_buttons = []
         self.bind(text=self.on_text)
         self.bind(on_focus=self.on_focus)
-        self.timer = None
+        # Ask the remote service once the user stops typing
+        self.remote_trigger = Clock.create_trigger(lambda dt: self.get_suggestions(self.text), SUGGESTION_DELAY)
 
     def on_text(self, instance, value):
-        if self.timer:
-            self.timer.cancel()
-        self.timer = Clock.schedule_once(lambda dt: self.get_suggestions(value), 1)
+        self.remote_trigger.cancel()
+        # Locations used before are suggested as soon as they're typed, the others after the delay
+        if not self.suggestion_service.suggest(value, self.show_suggestions, caller=self, remote=False):
+            self.remote_trigger()
         if value:
             if self.dropdown.parent:
                 self.dropdown.parent.remove_widget(self.dropdown)
@@ -539,33 +792,36 @@ class AutocompleteTextInput(TextInput):
                 self.dropdown.parent.remove_widget(self.dropdown)
 
     def on_focus(self, instance, value):
+        if value:
+            self.suggestion_service.prepare(App.get_running_app().user_id)
         if value and self.text:
             self.dropdown.open(self)
         else:
             self.dropdown.dismiss()
 
     def get_suggestions(self, value):
-        if value and len(value) <= 150:
-            try:
-                url = f'https://api.opencagedata.com/geocode/v1/json?q={value}&key={your_api_key}'
-                response = requests.get(url)
-                data = response.json()
-                if 'results' in data and data['results']:
-                    self.dropdown.clear_widgets()
-                    for result in data['results']:
-                        btn1 = Button(text=result['formatted'], size_hint_y=None,
-                                      height=44, background_color=[0, 1, 0, 1])
-                        btn1.bind(on_release=lambda btn1: self.select_suggestion(btn1.text))
-                        self.dropdown.add_widget(btn1)
-            except Exception as e:
-                print(f"Failed to get suggestions for location '{value}': {e}")
-        else:
-            if not value:
-                print('Invalid input: input is empty')
-            elif len(value) > 150:
-                print('Invalid input: input is too long')
+        self.suggestion_service.suggest(value, self.show_suggestions, caller=self)
+
+    def show_suggestions(self, value, results):
+        if value != self.text:
+            # Answer to an older text
+            return
+        self.dropdown.clear_widgets()
+        if not results:
+            # Nothing matches this text, the suggestions of the previous one don't either
+            if self.dropdown.parent:
+                self.dropdown.parent.remove_widget(self.dropdown)
+            return
+        for index, result in enumerate(results[:MAX_SUGGESTIONS]):
+            if index == len(self.suggestion_buttons):
+                button = Button(size_hint_y=None, height=44, background_color=[0, 1, 0, 1])
+                button.bind(on_release=lambda button: self.select_suggestion(button.text))
+                self.suggestion_buttons.append(button)
+            self.suggestion_buttons[index].text = result
+            self.dropdown.add_widget(self.suggestion_buttons[index])
 
     def select_suggestion(self, text):
+        self.suggestion_service.remember(text)
         self.text = text
         self.dropdown.dismiss()
 
@@ -581,6 +837,7 @@ class SecondScreen(BaseScreen):
     def __init__(self, **kwargs):
         super(SecondScreen, self).__init__(**kwargs)
         self.db_manager = DatabaseManager('comments.db')
+        self.api_manager = APIManager(your_api_key)
 
         # Add a background image to the screen
         self.bg = Image(source='images/back3.jpg', pos_hint={'center_x': 0.5, 'center_y': 0.5},
@@ -650,19 +907,46 @@ class SecondScreen(BaseScreen):
         comment = self.text_input.text.strip()
         location = self.location_input.text.strip()
         if comment and len(comment) <= 500:
-            try:
-                user_id = App.get_running_app().user_id
-                is_private = 1 if self.manager.get_screen('settings').is_private else 0
-                is_anonymous = 1 if self.manager.get_screen('settings').is_anonymous else 0
-                self.db_manager.insert_comment(user_id, self.topic, comment, location, is_private, is_anonymous)
-                self.text_input.text = ""
-                self.location_input.text = ""
-                self.manager.current = 'third'
-            except sqlite3.Error as e:
-                print(f"An error occurred: {e}")
+            user_id = App.get_running_app().user_id
+            is_private = 1 if self.manager.get_screen('settings').is_private else 0
+            is_anonymous = 1 if self.manager.get_screen('settings').is_anonymous else 0
+            self.submit_button.disabled = True
+            # Geocode once here so the map never has to geocode this comment again
+            BackgroundTask(self.geocode_location, location,
+                           on_done=lambda lat_lng: self.save_comment(user_id, self.topic, comment, location,
+                                                                     is_private, is_anonymous, lat_lng),
+                           on_error=self.on_publish_error).start()
         else:
             print('Invalid input!')
 
+    def geocode_location(self, task, location):
+        # Worker thread. Geocoding must never lose a comment: on any error it's saved without
+        # coordinates and backfill_coordinates fills them in later.
+        try:
+            return self.api_manager.get_location_coordinates(location)
+        except Exception as e:
+            logging.error(f"Failed to geocode location '{location}': {e}")
+            return None
+
+    def save_comment(self, user_id, topic, comment, location, is_private, is_anonymous, lat_lng):
+        lat = lon = None
+        if lat_lng:
+            lat, lon = lat_lng['lat'], lat_lng['lng']
+            # Suggested from memory next time it's typed
+            get_suggestion_service(your_api_key).remember(location)
+        database_worker.submit(self.db_manager.insert_comment, user_id, topic, comment, location, is_private,
+                               is_anonymous, lat, lon, on_done=self.on_comment_saved, on_error=self.on_publish_error)
+
+    def on_comment_saved(self, result):
+        self.submit_button.disabled = False
+        self.text_input.text = ""
+        self.location_input.text = ""
+        self.manager.current = 'third'
+
+    def on_publish_error(self, error):
+        self.submit_button.disabled = False
+        print(f"An error occurred: {error}")
+
     def on_button_press(self, button):
         self.manager.get_screen('third').topic = button.text
         self.manager.get_screen('third').color = self.colors[button.text]
@@ -687,8 +971,33 @@ class ThirdScreen(BaseScreen):
         self.screen_manager = screen_manager
         self.current_marker = None
         self.timer = None
-        self.map_view = MapView(zoom=11, lat=48.8534, lon=2.3488)  # Initialize map view
+        # Initialize map view, its tiles come from the packed tile store and work offline
+        self.map_view = MapView(zoom=11, lat=48.8534, lon=2.3488, map_source=PackedMapSource(get_tile_store()))
         self.add_widget(self.map_view)
+        # Tiles around the view and one zoom level in/out are decoded ahead of time
+        self.tile_prefetcher = TilePrefetcher(self.map_view, self.map_view.map_source)
+        self.prefetch_trigger = Clock.create_trigger(self.tile_prefetcher.prefetch, TILE_PREFETCH_DELAY)
+        # Reload the markers of the visible area once the user stops panning/zooming
+        self.viewport_trigger = Clock.create_trigger(self.load_viewport_markers, VIEWPORT_RELOAD_DELAY)
+        self.map_view.bind(on_map_relocated=self.on_map_relocated)
+        self.is_searching = False
+        self.cluster_index = None
+        # Comment positions already loaded, by id, and how far the database has been read:
+        # the last comment id seen, the last entry of comment_changes applied and the comments geocoded
+        # by then (see geocoded_comments)
+        self.points = {}
+        self.points_user_id = None
+        self.last_comment_id = 0
+        self.last_change_seq = 0
+        self.geocoded_comments = 0
+        # Background loading: the running tasks and the comments waiting for a marker
+        self.load_task = None
+        self.viewport_task = None
+        self.pending_comments = deque()
+        # When the current visit started loading the map, for the timing logs
+        self.load_started = None
+        self.wanted_ids = None
+        self.marker_event = None
 
         # Create a spinner
         self.spinner = Spinner(text='Loading...', values=('Loading...',), size_hint=(None, None), size=(100, 44))
@@ -708,7 +1017,15 @@ class ThirdScreen(BaseScreen):
 
         # Initialize search_results and current_result_index
         self.search_results = []
+        self.search_text = ''
+        self.search_has_more = False
+        self.is_loading_search_page = False
         self.current_result_index = 0
+        # Coordinates of search results geocoded in the background, by comment id
+        self.search_coordinates = {}
+        self.prefetch_task = None
+        # (current result index, number of results) the running prefetch was started for
+        self.prefetch_window = None
         # Create the search button
         search_button = self.create_button(text='Search',
                                            color=(0, 0, 125, 0.5), on_press_method=self.on_search_button_press)
@@ -716,7 +1033,7 @@ class ThirdScreen(BaseScreen):
 
         # Add the BoxLayout to the screen
         self.add_widget(search_layout)
-        self.markers = []  # List to keep track of all markers
+        self.markers = {}  # Markers currently on the map, by comment id
 
         # Create the "Next" and "Previous" buttons
         self.next_button = self.create_button(text='Next', color=(0, 0, 0, 1),
@@ -742,24 +1059,222 @@ class ThirdScreen(BaseScreen):
         # Schedule the long-running operation to run after a delay
         Clock.schedule_once(self.fetch_locations_and_add_markers, 0)
 
+    def on_leave(self, *args):
+        # Stop whatever is still loading for this visit
+        self.cancel_loading()
+        self.hide_spinner()
+
     def fetch_locations_and_add_markers(self, dt):
-        comments_with_locations = self.comment_manager.get_comments_with_locations()
+        # The database work runs on a worker thread, the map stays responsive meanwhile
+        user_id = App.get_running_app().user_id
+        self.cancel_loading()
+        if user_id != self.points_user_id:
+            # Someone else logged in, they don't see the same comments
+            self.points = {}
+            self.last_comment_id = self.last_change_seq = 0
+            self.cluster_index = None
+            self.clear_markers()
+        self.points_user_id = user_id
+        self.load_started = time.perf_counter()
+        self.load_task = BackgroundTask(self.load_map_data, user_id, dict(self.points), self.last_comment_id,
+                                        self.last_change_seq, self.geocoded_comments, self.cluster_index is None,
+                                        on_done=self.on_map_data_loaded, on_error=self.hide_spinner).start()
+
+    def load_map_data(self, task, user_id, points, last_comment_id, last_change_seq, geocoded, needs_index):
+        # Worker thread: only the comments added, updated or deleted since the last visit are read
+        db_manager = self.db_manager
+        # Counted before reading, a comment geocoded meanwhile is picked up on the next visit
+        new_geocoded = geocoded_comments()
+        if last_comment_id == 0:
+            change_seq, changed_ids = db_manager.get_last_change_seq(), set()
+        else:
+            change_seq, changed_ids = db_manager.get_comment_changes(last_change_seq)
+        comment_id = db_manager.get_last_comment_id()
+        if changed_ids is None or (last_comment_id and new_geocoded != geocoded):
+            # Changes were pruned before this screen applied them, or comments it had read got their
+            # coordinates since: every point is read again and every marker refreshed
+            changed_ids, points = set(points), {}
+            rows = db_manager.get_comment_points(user_id, up_to_id=comment_id)
+        else:
+            rows = db_manager.get_comment_points(user_id, after_id=last_comment_id, up_to_id=comment_id)
+            # Updated comments may have moved or become private, deleted ones are just gone
+            for id_ in changed_ids:
+                points.pop(id_, None)
+            rows += db_manager.get_comment_points(user_id, up_to_id=last_comment_id, comment_ids=changed_ids)
+        new_points = []
+        for id_, topic, lat, lon in rows:
+            points[id_] = (id_, topic.replace('Topic: ', ''), lat, lon)
+            if id_ > last_comment_id:
+                new_points.append(points[id_])
+
+        # Clusters for every zoom level are computed once here and reused while zooming
+        cluster_index = None
+        if needs_index or rows or changed_ids:
+            cluster_index = ClusterIndex(points.values())
+        # The map is fitted to every comment on the first visit, then to the ones added since
+        bounds = points_bounds(new_points, FIT_TRIM if last_comment_id == 0 else 0.0)
+        return points, comment_id, change_seq, new_geocoded, changed_ids, cluster_index, bounds
+
+    def on_map_data_loaded(self, result):
+        (self.points, self.last_comment_id, self.last_change_seq, self.geocoded_comments, changed_ids, cluster_index,
+         bounds) = result
+        # The changes applied here aren't needed anymore, unless a private search index still needs them
+        database_worker.submit(self.db_manager.prune_comment_changes, self.last_change_seq,
+                               key='prune_comment_changes')
+        self.log_map_timing(f"data of {len(self.points)} comments loaded")
+        # Markers of updated/deleted comments are stale
+        for id_ in changed_ids:
+            if id_ in self.markers:
+                self.remove_marker(self.markers.pop(id_))
+        if cluster_index is not None:
+            self.cluster_index = cluster_index
+        # Move the map once, then only load what's inside the view
+        if bounds:
+            self.fit_bounds(bounds)
+        self.load_viewport_markers()
+
+    def fit_bounds(self, bounds, max_zoom=MAX_FIT_ZOOM):
+        # Zoom and center the map so bounds (lat_min, lon_min, lat_max, lon_max) is all visible
+        map_source = self.map_view.map_source
+        padding = min(FIT_PADDING, self.map_view.width / 10, self.map_view.height / 10)
+        zoom = fit_zoom(bounds, self.map_view.width - 2 * padding, self.map_view.height - 2 * padding,
+                        map_source.get_min_zoom(), min(max_zoom, map_source.get_max_zoom()), map_source.dp_tile_size)
+        self.map_view.zoom = zoom
+        self.map_view.center_on(*bounds_center(bounds))
+        self.log_map_timing(f"fitted to the comments at zoom {zoom}")
+
+    def log_map_timing(self, stage, done=False):
+        # How long each step of loading the map took on this visit
+        if self.load_started is None:
+            return
+        logging.info(f"Map {stage} after {(time.perf_counter() - self.load_started) * 1000:.0f} ms")
+        if done:
+            self.load_started = None
+
+    def cancel_loading(self):
+        for task in (self.load_task, self.viewport_task):
+            if task is not None:
+                task.cancel()
+        self.load_task = self.viewport_task = None
+        self.pending_comments.clear()
+        if self.marker_event is not None:
+            self.marker_event.cancel()
+            self.marker_event = None
+
+    def hide_spinner(self, *args):
+        self.spinner.active = False
+        if self.spinner.parent:
+            self.remove_widget(self.spinner)
+
+    def on_map_relocated(self, map_view, zoom, coord):
+        # Called for every frame of a pan/zoom, restart the delay each time
+        self.viewport_trigger.cancel()
+        self.viewport_trigger()
+        self.prefetch_trigger.cancel()
+        self.prefetch_trigger()
+
+    def load_viewport_markers(self, *args):
+        if self.is_searching or self.cluster_index is None:
+            # Nothing to load for the view (search results are shown instead), don't leave the spinner up
+            self.hide_spinner()
+            return
+        # Anything still loading was for the previous view
+        if self.viewport_task is not None:
+            self.viewport_task.cancel()
+        self.pending_comments.clear()
 
-        for (id_, user_id, topic, comment, location, lat, lon,
-             is_anonymous, anonymous_username, username, timestamp) in comments_with_locations:
+        user_id = App.get_running_app().user_id
+        bbox = self.map_view.get_bbox()
+        if self.map_view.zoom <= MAX_CLUSTER_ZOOM:
+            visible_ids = set()
+            for cluster in self.cluster_index.get_clusters(bbox, self.map_view.zoom):
+                if cluster.count == 1:
+                    visible_ids.add(cluster.comment_id)
+                    continue
+                key = ('cluster', cluster.id)
+                visible_ids.add(key)
+                if key not in self.markers:
+                    marker = ClusterMarker(cluster, self.colors)
+                    marker.bind(on_release=self.expand_cluster)
+                    self.markers[key] = marker
+                    self.map_view.add_widget(marker)
+            # Drop the markers that left the view
+            for id_ in list(self.markers):
+                if id_ not in visible_ids:
+                    self.remove_marker(self.markers.pop(id_))
+            # Single comments get a normal marker, only load the ones not on the map yet
+            self.wanted_ids = {id_ for id_ in visible_ids if not isinstance(id_, tuple)}
+            new_ids = [id_ for id_ in self.wanted_ids if id_ not in self.markers]
+            query = (None, new_ids)
+        else:
+            # Zoomed in past the clusters, show every comment of the area
+            for id_, marker in list(self.markers.items()):
+                if isinstance(id_, tuple) or not bbox.collide(marker.lat, marker.lon):
+                    self.remove_marker(self.markers.pop(id_))
+            self.wanted_ids = None
+            query = (bbox, None)
+
+        self.viewport_task = BackgroundTask(self.fetch_comments, user_id, *query, on_batch=self.queue_markers,
+                                            on_done=self.on_viewport_loaded, on_error=self.hide_spinner).start()
+
+    def on_viewport_loaded(self, result):
+        self.hide_spinner()
+        if not self.pending_comments:
+            self.log_map_timing(f"ready with {len(self.markers)} markers", done=True)
+
+    def fetch_comments(self, task, user_id, bbox, comment_ids):
+        # Worker thread: read, decrypt and geocode the comments, sent back in batches
+        comment_manager = CommentManager(self.db_manager, self.api_manager)
+        comments = comment_manager.get_comments(bbox=bbox, limit=MAX_VIEWPORT_MARKERS, comment_ids=comment_ids,
+                                                user_id=user_id)
+        for start in range(0, len(comments), MARKER_BATCH_SIZE):
+            if task.is_cancelled:
+                return
+            task.emit(comment_manager.locate_comments(comments[start:start + MARKER_BATCH_SIZE]))
+
+    def queue_markers(self, comments_with_locations):
+        self.pending_comments.extend(comments_with_locations)
+        if self.marker_event is None:
+            self.marker_event = Clock.schedule_interval(self.add_pending_markers, 0)
+
+    def add_pending_markers(self, dt):
+        # A few markers per frame so the map keeps drawing while they arrive
+        for _ in range(min(MARKERS_PER_FRAME, len(self.pending_comments))):
+            (id_, user_id, topic, comment, location, lat, lon,
+             is_anonymous, anonymous_username, username, timestamp) = self.pending_comments.popleft()
+            if id_ in self.markers or (self.wanted_ids is not None and id_ not in self.wanted_ids):
+                continue
 
             # Remove 'Topic: ' from the topic string
             topic = topic.replace('Topic: ', '')
             color1 = self.colors.get(topic, '#FF0000')  # Get the color for the topic, or default to red
             marker = CommentMarker(comment=comment, is_anonymous=is_anonymous, username=username, timestamp=timestamp, lat=lat, lon=lon,
                                    color1=color1, screen_manager=self.screen_manager)
-            self.markers.append(marker)
+            self.markers[id_] = marker
             self.map_view.add_widget(marker)
-            self.map_view.center_on(lat, lon)
 
-        # Hide the loading spinner
-        self.spinner.active = False
-        self.remove_widget(self.spinner)
+        if not self.pending_comments:
+            self.marker_event.cancel()
+            self.marker_event = None
+            if self.viewport_task is not None and self.viewport_task.future.done():
+                self.log_map_timing(f"ready with {len(self.markers)} markers", done=True)
+
+    def remove_marker(self, marker):
+        # Give an opened bubble back to the pool before dropping the marker
+        if isinstance(marker, CommentMarker):
+            marker.release_bubble()
+        self.map_view.remove_widget(marker)
+
+    def expand_cluster(self, marker):
+        # Zoom in to the level where the cluster splits up
+        cluster = marker.cluster
+        self.map_view.zoom = min(cluster.expansion_zoom, self.map_view.map_source.get_max_zoom())
+        self.map_view.center_on(cluster.lat, cluster.lon)
+
+    def clear_markers(self):
+        for marker in self.markers.values():
+            self.remove_marker(marker)
+        self.markers.clear()
 
     def create_callback(self, location, comment):
         return lambda dt: self.get_location_coordinates(location, comment)
@@ -769,16 +1284,48 @@ class ThirdScreen(BaseScreen):
         search_text = self.search_bar.text
 
         # Clear all markers from the map view
-        for marker in self.markers:
-            self.map_view.remove_widget(marker)
+        self.cancel_loading()
+        self.clear_markers()
+        if self.current_marker:
+            self.remove_marker(self.current_marker)
         self.current_marker = None
 
-        # Filter comments that match the search text
+        # Prefetches were for the previous search
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        self.prefetch_window = None
+
+        # An empty search goes back to showing the comments of the visible area
+        if not search_text:
+            self.is_searching = False
+            self.search_results = []
+            self.next_button.disabled = True
+            self.prev_button.disabled = True
+            if self.cluster_index is None:
+                self.fetch_locations_and_add_markers(0)
+            else:
+                self.load_viewport_markers()
+            return
+        self.is_searching = True
+
+        # Ranked results from the search index, one page at a time
         user_id = App.get_running_app().user_id
-        self.search_results = [comment for comment in self.db_manager.get_comments(user_id) if search_text in comment[3]]
+        self.search_text = search_text
+        self.search_results = []
+        self.search_coordinates = {}
 
         # Reset the current result index
         self.current_result_index = 0
+        database_worker.submit(self.db_manager.search_comments, user_id, search_text,
+                               on_done=lambda results: self.on_search_results(search_text, results))
+
+    def on_search_results(self, search_text, results):
+        # Ignore the results of a search the user has replaced since
+        if not self.is_searching or search_text != self.search_text:
+            return
+        self.search_results = results
+        self.search_has_more = len(self.search_results) == SEARCH_PAGE_SIZE
 
         # Display the first search result if there is one
         if self.search_results:
@@ -789,11 +1336,17 @@ class ThirdScreen(BaseScreen):
     def update_display(self):
         # Remove old marker from map view
         if self.current_marker:
-            self.map_view.remove_widget(self.current_marker)
+            self.remove_marker(self.current_marker)
 
         # Add new marker to map view
         comment = self.search_results[self.current_result_index]
-        lat_lng = self.api_manager.get_location_coordinates(comment[4])
+        if comment[10] is not None:
+            lat_lng = {'lat': comment[10], 'lng': comment[11]}
+        else:
+            # Not geocoded yet: the prefetch below shows it once its coordinates arrive
+            lat_lng = self.search_coordinates.get(comment[0])
+        # Get the neighbours ready before the user presses Next/Previous
+        self.prefetch_search_coordinates()
         if lat_lng:
             lat, lon = lat_lng['lat'], lat_lng['lng']
 
@@ -806,11 +1359,76 @@ class ThirdScreen(BaseScreen):
             self.current_marker = marker
             self.map_view.add_widget(marker)
             self.map_view.center_on(lat, lon)
-            self.db_manager.close()
+
+    def prefetch_search_coordinates(self):
+        count = len(self.search_results)
+        # Redisplaying the same result (its coordinates just arrived) keeps the running prefetch going
+        window = (self.current_result_index, count)
+        if window == self.prefetch_window:
+            return
+        self.prefetch_window = window
+        indexes = {(self.current_result_index + step) % count for step in range(-SEARCH_PREFETCH, SEARCH_PREFETCH + 1)}
+        # Only the results without stored coordinates need the network
+        missing = [(comment[0], comment[4]) for comment in (self.search_results[index] for index in indexes)
+                   if comment[10] is None and comment[0] not in self.search_coordinates]
+        if not missing:
+            return
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+        self.prefetch_task = BackgroundTask(self.geocode_search_results, missing,
+                                            on_batch=self.on_search_coordinates).start()
+
+    def on_search_coordinates(self, coordinates):
+        self.search_coordinates.update(coordinates)
+        if not self.search_results:
+            return
+        # The result on screen was waiting for its coordinates
+        comment = self.search_results[self.current_result_index]
+        if comment[10] is None and coordinates.get(comment[0]):
+            self.update_display()
+
+    def geocode_search_results(self, task, comments):
+        # Worker thread: geocode and store the coordinates so the next search has them too
+        for comment_id, location in comments:
+            if task.is_cancelled:
+                return
+            try:
+                lat_lng = self.api_manager.get_location_coordinates(location)
+            except requests.RequestException as e:
+                logging.error(f"Failed to geocode comment {comment_id}: {e}")
+                continue
+            task.emit({comment_id: lat_lng})
+            if lat_lng:
+                self.db_manager.update_comment_coordinates(comment_id, lat_lng['lat'], lat_lng['lng'])
+
+    def load_more_search_results(self):
+        # Loads the next page, then moves on to its first result
+        if self.is_loading_search_page:
+            return
+        self.is_loading_search_page = True
+        user_id = App.get_running_app().user_id
+        search_text = self.search_text
+        database_worker.submit(self.db_manager.search_comments, user_id, search_text, SEARCH_PAGE_SIZE,
+                               len(self.search_results),
+                               on_done=lambda page: self.on_search_page(search_text, page),
+                               on_error=lambda error: setattr(self, 'is_loading_search_page', False))
+
+    def on_search_page(self, search_text, page):
+        self.is_loading_search_page = False
+        if not self.is_searching or search_text != self.search_text:
+            return
+        self.search_results.extend(page)
+        self.search_has_more = len(page) == SEARCH_PAGE_SIZE
+        self.current_result_index = (self.current_result_index + 1) % len(self.search_results)
+        self.update_display()
 
     def on_next_button_press(self, instance):
         # Increment the current result index and wrap around if necessary
         if self.search_results:
+            # Load the next page when reaching the end of the loaded results
+            if self.current_result_index == len(self.search_results) - 1 and self.search_has_more:
+                self.load_more_search_results()
+                return
             self.current_result_index = (self.current_result_index + 1) % len(self.search_results)
             self.update_display()
 
@@ -0,0 +1,160 @@
+from math import atan, cos, degrees, exp, log, log10, pi, radians, tan
+from itertools import count
+from kivy.graphics import Color, Ellipse
+from kivy.metrics import dp
+from kivy.uix.label import Label
+from kivy.utils import get_color_from_hex
+from kivy_garden.mapview import MapMarker
+
+
+# Size in pixels of a grid cell: points closer than this on screen end up in the same cluster
+GRID_SIZE = 60
+
+# Clusters are computed for zoom levels MIN_CLUSTER_ZOOM..MAX_CLUSTER_ZOOM,
+# above that every comment gets its own marker
+MIN_CLUSTER_ZOOM = 0
+MAX_CLUSTER_ZOOM = 16
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511
+
+
+def lon_to_x(lon, zoom):
+    # Web Mercator pixel coordinates, (0, 0) is the top left of the world
+    return (lon + 180.0) / 360.0 * TILE_SIZE * 2 ** zoom
+
+
+def lat_to_y(lat, zoom):
+    lat = radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+    return (1.0 - log(tan(lat) + 1.0 / cos(lat)) / pi) / 2.0 * TILE_SIZE * 2 ** zoom
+
+
+def y_to_lat(y, zoom):
+    n = pi * (1.0 - 2.0 * y / (TILE_SIZE * 2 ** zoom))
+    return degrees(atan(0.5 * (exp(n) - exp(-n))))
+
+
+def points_bounds(points, trim=0.0):
+    # (lat_min, lon_min, lat_max, lon_max) of (comment_id, topic, lat, lon) points, None if empty.
+    # trim leaves out that fraction of the most outlying points on each side.
+    if not points:
+        return None
+    lats = sorted(point[2] for point in points)
+    lons = sorted(point[3] for point in points)
+    low = int(len(lats) * trim)
+    high = len(lats) - 1 - low
+    return lats[low], lons[low], lats[high], lons[high]
+
+
+def fit_zoom(bounds, width, height, min_zoom=0, max_zoom=MAX_CLUSTER_ZOOM, tile_size=TILE_SIZE):
+    # Highest zoom level showing the whole of bounds in width x height pixels
+    lat_min, lon_min, lat_max, lon_max = bounds
+    scale = tile_size / TILE_SIZE
+    for zoom in range(max_zoom, min_zoom, -1):
+        box_width = (lon_to_x(lon_max, zoom) - lon_to_x(lon_min, zoom)) * scale
+        box_height = (lat_to_y(lat_min, zoom) - lat_to_y(lat_max, zoom)) * scale
+        if box_width <= width and box_height <= height:
+            return zoom
+    return min_zoom
+
+
+def bounds_center(bounds):
+    # Middle of bounds on the (Mercator) map, not the average latitude
+    lat_min, lon_min, lat_max, lon_max = bounds
+    return y_to_lat((lat_to_y(lat_min, 0) + lat_to_y(lat_max, 0)) / 2, 0), (lon_min + lon_max) / 2
+
+
+class Cluster:
+    __slots__ = ('id', 'lat', 'lon', 'count', 'topics', 'comment_id', 'expansion_zoom')
+
+    _ids = count(1)
+
+    def __init__(self, lat, lon, count, topics, comment_id=None):
+        self.id = next(Cluster._ids)
+        self.lat = lat
+        self.lon = lon
+        self.count = count
+        self.topics = topics  # topic -> number of comments
+        self.comment_id = comment_id  # Only set for a single comment
+        self.expansion_zoom = None  # Zoom level where this cluster splits up
+
+
+class ClusterIndex:
+    def __init__(self, points, min_zoom=MIN_CLUSTER_ZOOM, max_zoom=MAX_CLUSTER_ZOOM, grid_size=GRID_SIZE):
+        # points: (comment_id, topic, lat, lon) tuples
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.grid_size = grid_size
+        self.levels = {}
+        clusters = [Cluster(lat, lon, 1, {topic: 1}, comment_id) for comment_id, topic, lat, lon in points]
+        self.size = len(clusters)
+        # Each zoom level is built from the clusters of the level above it
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            clusters = self.cluster_level(clusters, zoom)
+            self.levels[zoom] = clusters
+
+    def cluster_level(self, clusters, zoom):
+        cells = {}
+        for cluster in clusters:
+            key = (int(lon_to_x(cluster.lon, zoom) // self.grid_size),
+                   int(lat_to_y(cluster.lat, zoom) // self.grid_size))
+            cells.setdefault(key, []).append(cluster)
+
+        merged = []
+        for members in cells.values():
+            if len(members) == 1:
+                # Keep the same object so its marker survives the zoom change
+                merged.append(members[0])
+                continue
+            total = sum(member.count for member in members)
+            topics = {}
+            for member in members:
+                for topic, topic_count in member.topics.items():
+                    topics[topic] = topics.get(topic, 0) + topic_count
+            cluster = Cluster(sum(member.lat * member.count for member in members) / total,
+                              sum(member.lon * member.count for member in members) / total,
+                              total, topics)
+            cluster.expansion_zoom = zoom + 1
+            merged.append(cluster)
+        return merged
+
+    def get_clusters(self, bbox, zoom):
+        # Clusters inside bbox (lat_min, lon_min, lat_max, lon_max) at this zoom level
+        zoom = max(self.min_zoom, min(self.max_zoom, int(zoom)))
+        lat_min, lon_min, lat_max, lon_max = bbox
+        lat_min, lat_max = min(lat_min, lat_max), max(lat_min, lat_max)
+        lon_min, lon_max = min(lon_min, lon_max), max(lon_min, lon_max)
+        return [cluster for cluster in self.levels.get(zoom, [])
+                if lat_min <= cluster.lat <= lat_max and lon_min <= cluster.lon <= lon_max]
+
+
+class ClusterMarker(MapMarker):
+    def __init__(self, cluster, colors, **kwargs):
+        # Draw a pie of the topics instead of the default marker image
+        super(ClusterMarker, self).__init__(lat=cluster.lat, lon=cluster.lon, source='', color=(1, 1, 1, 0), **kwargs)
+        self.cluster = cluster
+        self.colors = colors
+        self.anchor_y = 0.5
+        size = dp(30 + 12 * log10(cluster.count))
+        self.size = (size, size)
+
+        self.count_label = Label(text=str(cluster.count), bold=True, color=(0, 0, 0, 1), font_size='12sp')
+        self.add_widget(self.count_label)
+        self.bind(pos=self.update_graphics, size=self.update_graphics)
+        self.update_graphics()
+
+    def update_graphics(self, *args):
+        self.canvas.before.clear()
+        with self.canvas.before:
+            # One slice per topic, sized by the number of comments
+            angle = 0
+            for topic, topic_count in sorted(self.cluster.topics.items()):
+                sweep = 360.0 * topic_count / self.cluster.count
+                Color(*get_color_from_hex(self.colors.get(topic, '#FF0000')))
+                Ellipse(pos=self.pos, size=self.size, angle_start=angle, angle_end=angle + sweep)
+                angle += sweep
+            # White center for the count
+            Color(1, 1, 1, 1)
+            inner = self.width * 0.6
+            Ellipse(pos=(self.center_x - inner / 2, self.center_y - inner / 2), size=(inner, inner))
+        self.count_label.center = self.center
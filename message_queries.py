@@ -0,0 +1,124 @@
+import sqlite3
+import sys
+
+from database_schema import ensure_schema
+
+
+# The hot queries on messages and conversations. They are written so SQLite answers them
+# from the indexes the migrations in database_schema.py add: a pair of users is matched on
+# (min, max) of the participant ids instead of an OR of both directions, which can't use
+# an index. audit_query_plans checks none of them scans a table.
+
+THREAD_ID_FOR_PAIR = """
+    SELECT thread_id FROM thread_participants WHERE user_lo = min(?, ?) AND user_hi = max(?, ?)
+"""
+
+# Messages of a thread between two users with their sender's username, callers add the paging
+# clauses and ORDER BY
+THREAD_MESSAGES = """
+    SELECT id, sender_id, message, timestamp,
+           (SELECT username FROM users WHERE users.id = messages.sender_id) AS sender_name
+    FROM messages
+    WHERE thread_id = ?
+      AND min(sender_id, receiver_id) = min(?, ?) AND max(sender_id, receiver_id) = max(?, ?)
+"""
+
+USER_THREAD_MESSAGES = """
+    SELECT id, message, timestamp FROM messages
+    WHERE thread_id = ? AND (sender_id = ? OR receiver_id = ?)
+    ORDER BY timestamp DESC
+"""
+
+USER_THREAD_IDS = """
+    SELECT thread_id FROM messages WHERE sender_id = ?
+    UNION
+    SELECT thread_id FROM messages WHERE receiver_id = ?
+"""
+
+# Everything up to the last message of the conversation is read
+MARK_CONVERSATION_READ = """
+    UPDATE conversations SET unread_count = 0, last_read_id = last_message_id
+    WHERE user_id = ? AND partner_id = ? AND unread_count > 0
+"""
+
+USER_CONVERSATIONS = """
+    SELECT conversations.partner_id, users.username, conversations.thread_id,
+           conversations.last_message_at, conversations.unread_count
+    FROM conversations
+    JOIN users ON users.id = conversations.partner_id
+    WHERE conversations.user_id = ?
+    ORDER BY conversations.last_message_at DESC
+    LIMIT ?
+"""
+
+LATEST_FEED_SEQ = "SELECT max(seq) FROM message_feed"
+
+OLDEST_FEED_SEQ = "SELECT min(seq) FROM message_feed"
+
+# Drops the changes up to a seq, always keeping the latest one so the feed position is never lost
+PRUNE_FEED = """
+    DELETE FROM message_feed WHERE seq <= ? AND seq < (SELECT max(seq) FROM message_feed)
+"""
+
+# Changes to the messages of a user in (since, until]
+USER_FEED_CHANGES = """
+    SELECT seq, change, message_id, thread_id, sender_id, receiver_id FROM message_feed
+    WHERE seq > ? AND seq <= ? AND (sender_id = ? OR receiver_id = ?)
+    ORDER BY seq
+"""
+
+USER_ID_FOR_USERNAME = "SELECT id FROM users WHERE username = ?"
+
+USERNAME_FOR_USER_ID = "SELECT username FROM users WHERE id = ?"
+
+
+def pair_params(user1_id, user2_id):
+    # Parameters for a "min(...) = min(?, ?) AND max(...) = max(?, ?)" pair match
+    return user1_id, user2_id, user1_id, user2_id
+
+
+# name -> (query, example parameters), as the app runs them
+HOT_QUERIES = {
+    'thread_id_for_pair': (THREAD_ID_FOR_PAIR, pair_params(1, 2)),
+    'thread_messages': (THREAD_MESSAGES + " ORDER BY timestamp ASC", (1,) + pair_params(1, 2)),
+    'thread_messages_latest_page': (THREAD_MESSAGES + " ORDER BY timestamp DESC, id DESC LIMIT ?",
+                                    (1,) + pair_params(1, 2) + (30,)),
+    'thread_messages_older_page': (THREAD_MESSAGES + " AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?",
+                                   (1,) + pair_params(1, 2) + ('2024-01-01 00:00:00.000000', 1, 30)),
+    'thread_messages_newer_page': (THREAD_MESSAGES + " AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?",
+                                   (1,) + pair_params(1, 2) + ('2024-01-01 00:00:00.000000', 1, 30)),
+    'user_thread_messages': (USER_THREAD_MESSAGES, (1, 1, 1)),
+    'user_thread_ids': (USER_THREAD_IDS, (1, 1)),
+    'user_conversations': (USER_CONVERSATIONS, (1, -1)),
+    'user_id_for_username': (USER_ID_FOR_USERNAME, ('a',)),
+    'latest_feed_seq': (LATEST_FEED_SEQ, ()),
+    'oldest_feed_seq': (OLDEST_FEED_SEQ, ()),
+    'prune_feed': (PRUNE_FEED, (100,)),
+    'user_feed_changes': (USER_FEED_CHANGES, (0, 100, 1, 1)),
+}
+
+# Tables that must never be read with a full scan
+AUDITED_TABLES = ('messages', 'conversations', 'thread_participants', 'users', 'message_feed')
+
+
+def audit_query_plans(conn):
+    # EXPLAIN QUERY PLAN every hot query, returns the (name, plan step) that scan a whole table
+    problems = []
+    for name, (query, params) in HOT_QUERIES.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + query, params):
+            detail = row[-1]
+            if any(detail.startswith(f"SCAN {table}") for table in AUDITED_TABLES):
+                problems.append((name, detail))
+    return problems
+
+
+if __name__ == '__main__':
+    # python message_queries.py [database]: fails if a hot query regressed to a table scan
+    db_path = sys.argv[1] if len(sys.argv) > 1 else 'comments.db'
+    ensure_schema(db_path)
+    with sqlite3.connect(db_path) as conn:
+        problems = audit_query_plans(conn)
+    for name, detail in problems:
+        print(f"{name}: {detail}")
+    print(f"{len(HOT_QUERIES)} queries checked, {len(problems)} table scans")
+    sys.exit(1 if problems else 0)
@@ -7,39 +7,148 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.bubble import Bubble
+import time
+from collections import deque
 from datetime import datetime
-from kivy.uix.scrollview import ScrollView
+from comments_manager import MESSAGE_PAGE_SIZE
 from kivy.uix.image import Image
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.core.text import Label as CoreLabel
+from kivy.metrics import sp
+from kivy.clock import Clock
+from background_tasks import database_worker
+from kivy.utils import escape_markup
 
 
-class UserLabel(Button):
-    def __init__(self, text, id, user_list_screen, **kwargs):
+# How often the message feed is checked for messages from other devices / app instances, in seconds
+FEED_POLL_INTERVAL = 1.5
+
+# message_feed keeps the changes of the last FEED_RETENTION seconds, pruned every FEED_PRUNE_INTERVAL
+# by the running app. An app whose last poll is older than that (asleep, suspended) has missed
+# changes: it reloads what it shows instead.
+FEED_RETENTION = 24 * 60 * 60
+FEED_PRUNE_INTERVAL = 10 * 60
+
+
+class MessageFeedPoller:
+    # Polls MessageManager.poll_since on the database thread and hands the new changes to the
+    # listeners on the main thread (None if some were pruned before this app saw them). Only reads
+    # the message_feed rows added since the last poll, and prunes the ones older than retention.
+    def __init__(self, message_manager, interval=FEED_POLL_INTERVAL, retention=FEED_RETENTION,
+                 prune_interval=FEED_PRUNE_INTERVAL):
+        self.message_manager = message_manager
+        self.interval = interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.seq = None
+        self.listeners = []
+        self.event = None
+        # (time.monotonic(), feed seq at that time), one every prune_interval: everything up to
+        # the seq of a mark older than retention can be pruned
+        self.marks = deque()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        if self.event is None:
+            self.poll()  # Sets the starting position
+            self.event = Clock.schedule_interval(self.poll, self.interval)
+
+    def stop(self):
+        if self.event is not None:
+            self.event.cancel()
+            self.event = None
+
+    def poll(self, dt=None):
+        # A poll still waiting for the database thread is reused instead of queuing another one
+        database_worker.submit(self.message_manager.poll_since, self.seq,
+                               key=('message_feed', self.message_manager.user_id), on_done=self.on_polled)
+
+    def on_polled(self, result):
+        changes, seq = result
+        self.seq = max(seq, self.seq or 0)
+        if (changes or changes is None) and self.event is not None:
+            for listener in self.listeners:
+                listener(changes)
+        self.prune()
+
+    def prune(self):
+        now = time.monotonic()
+        if not self.marks or now - self.marks[-1][0] >= self.prune_interval:
+            self.marks.append((now, self.seq))
+        expired_seq = None
+        while self.marks and now - self.marks[0][0] >= self.retention:
+            expired_seq = self.marks.popleft()[1]
+        if expired_seq:
+            database_worker.submit(self.message_manager.prune_feed, expired_seq, key='prune_message_feed')
+
+
+class UserLabel(RecycleDataViewBehavior, Button):
+    # One row of the user list, recycled by the RecycleView like the message rows
+    def __init__(self, **kwargs):
         super(UserLabel, self).__init__(**kwargs)
-        self.text = text
-        self.id = id
-        self.user_list_screen = user_list_screen
-        self.bind(on_release=lambda instance: self.user_list_screen.user_selected(self.id))
+        self.user_id = None
+        self.thread_id = None
+        self.user_list_screen = None
+        self.markup = True
+        self.bind(on_release=lambda instance: self.user_list_screen.user_selected(self.user_id, self.thread_id))
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.user_id = data['user_id']
+        self.thread_id = data['thread_id']
+        self.user_list_screen = data['user_list_screen']
+        self.text = data['text']
+        return super(UserLabel, self).refresh_view_attrs(rv, index, data)
 
 
-class MessageBubble(Bubble):
-    def __init__(self, message_id, sender, message, timestamp, delete_callback, **kwargs):
+class UserList(RecycleView):
+    def __init__(self, **kwargs):
+        super(UserList, self).__init__(**kwargs)
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None, default_size=(None, 100),
+                                  default_size_hint=(1, None))
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self.viewclass = UserLabel
+
+
+# Fixed bubble width, the message text wraps at 90% of it
+BUBBLE_WIDTH = 360
+MESSAGE_TEXT_WIDTH = BUBBLE_WIDTH * .9
+MESSAGE_FONT_SIZE = '15sp'
+# Everything in a row that isn't the message text: paddings, the Delete button and the timestamp
+ROW_EXTRA_HEIGHT = 140
+
+
+def measure_message_height(text):
+    # Height of the wrapped message text, without creating a widget
+    label = CoreLabel(text=text, font_size=sp(15), text_size=(MESSAGE_TEXT_WIDTH, None), halign='center')
+    label.refresh()
+    return label.texture.height if label.texture else 0
+
+
+class MessageBubble(RecycleDataViewBehavior, AnchorLayout):
+    # One row of the message list. The RecycleView only creates enough rows to fill the screen
+    # and reuses them while scrolling, refresh_view_attrs fills a row with another message.
+    def __init__(self, **kwargs):
         super(MessageBubble, self).__init__(**kwargs)
-        self.size_hint = (None, None)
-        self.size = (360, 90)
-        self.arrow_pos = 'bottom_left' if sender == "You" else 'bottom_right'
-        self.padding = "8dp"
-        self.pos_hint = {'x': 0} if sender == "You" else {'right': 1}
-        self.background_color = [1, 1, 1, 1]
-        self.border = [10, 10, 10, 10]
-        self.bubble_border = [15, 15, 15, 15]
+        self.padding = (15, 15)
+        self.message_id = None
+        self.delete_callback = None
         self.color = [0, 0, 0, 1]
 
-        self.lbl = Label(text=f"{message}", color=self.color, text_size=(self.width * .9, None), size_hint_y=None, halign='center', valign='middle')
-        self.lbl.bind(texture_size=self.adjust_size)
-        self.timestamp_lbl = Label(text=f"{timestamp.strftime('%H:%M')} {timestamp.strftime('%d/%m/%Y')}", font_size='10sp', halign='right', valign='bottom', color=self.color)  # Align to the right
-        self.timestamp_lbl.bind(texture_size=self.adjust_size)
+        self.bubble = Bubble(size_hint=(None, None), width=BUBBLE_WIDTH, padding="8dp")
+        self.bubble.background_color = [1, 1, 1, 1]
+        self.bubble.border = [10, 10, 10, 10]
+        self.bubble.bubble_border = [15, 15, 15, 15]
+
+        self.lbl = Label(color=self.color, font_size=MESSAGE_FONT_SIZE, text_size=(MESSAGE_TEXT_WIDTH, None),
+                         size_hint_y=None, halign='center', valign='middle')
+        self.timestamp_lbl = Label(font_size='10sp', halign='right', valign='bottom', color=self.color)  # Align to the right
         self.delete_button = Button(text='Delete', size_hint=(None, None), size=(50, 50))
-        self.delete_button.bind(on_release=lambda x: delete_callback(message_id, self))
+        self.delete_button.bind(on_release=lambda x: self.delete_callback(self.message_id))
 
         box_layout = BoxLayout(orientation='vertical', padding=(10, 10), spacing=20)
         box_layout.add_widget(self.lbl)
@@ -50,25 +159,42 @@ class MessageBubble(Bubble):
 
         box_layout.add_widget(bottom_layout)
 
-        layout = AnchorLayout(anchor_x='left' if sender == "You" else 'right', padding=(15, 15))
-        layout.add_widget(box_layout)
-
-        with layout.canvas.before:
+        with box_layout.canvas.before:
             Color(1, 1, 1, 1)
-            self.rect = RoundedRectangle(pos=layout.pos, size=layout.size)
+            self.rect = RoundedRectangle(pos=box_layout.pos, size=box_layout.size)
 
-        self.add_widget(layout)
-        layout.bind(size=self.update_rect, pos=self.update_rect)
+        self.bubble.add_widget(box_layout)
+        self.add_widget(self.bubble)
+        box_layout.bind(size=self.update_rect, pos=self.update_rect)
 
-    def adjust_size(self, instance, value):
-        # Set the height of the bubble to be the sum of the heights of the labels and the padding
-        self.height = self.lbl.height + self.timestamp_lbl.height + 20
+    def refresh_view_attrs(self, rv, index, data):
+        self.message_id = data['message_id']
+        self.delete_callback = data['delete_callback']
+        is_mine = data['sender'] == "You"
+        self.anchor_x = 'left' if is_mine else 'right'
+        self.bubble.arrow_pos = 'bottom_left' if is_mine else 'bottom_right'
+        self.lbl.text = data['message']
+        # Measured once per message by the screen, no need to wait for the texture
+        self.lbl.height = data['text_height']
+        self.timestamp_lbl.text = data['timestamp']
+        self.bubble.height = data['height'] - self.padding[1] - self.padding[3]
+        return super(MessageBubble, self).refresh_view_attrs(rv, index, data)
 
     def update_rect(self, instance, value):
         self.rect.pos = instance.pos
         self.rect.size = instance.size
 
 
+class MessageList(RecycleView):
+    def __init__(self, **kwargs):
+        super(MessageList, self).__init__(**kwargs)
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None, default_size_hint=(1, None))
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        # Forwarded to the layout manager, so only once it's added
+        self.viewclass = MessageBubble
+
+
 class MessageScreen(Screen):
     def __init__(self, user_id, username, message_manager, database_manager, receiver_id=None, **kwargs):
         super(MessageScreen, self).__init__(**kwargs)
@@ -82,15 +208,21 @@ class MessageScreen(Screen):
         self.receiver_id = receiver_id
         self.sender_id = self.user_id
         self.is_loading = False
-        self.has_new_messages = False
         self.messages = []
         self.thread_id = None
+        # (timestamp, id) of the oldest and newest loaded messages, for keyset pagination
+        self.oldest_key = None
+        self.newest_key = None
+        self.has_older_messages = False
+        # message id -> height of its wrapped text, so each message is only measured once
+        self.text_heights = {}
+        # sender id -> username, filled by the database thread with each page
+        self.usernames = {}
+        # Bumped whenever another conversation is opened, so late pages of the previous one are dropped
+        self.conversation = 0
         self.layout = BoxLayout(orientation='vertical')
-        self.message_list = BoxLayout(orientation='vertical', size_hint_y=None)
-        self.message_list.bind(minimum_height=self.message_list.setter('height'))
-        self.scroll_view = ScrollView()
-        self.scroll_view.add_widget(self.message_list)
-        self.scroll_view.bind(scroll_y=self.check_scroll)
+        self.message_list = MessageList()
+        self.message_list.bind(scroll_y=self.check_scroll)
         send_layout = BoxLayout(size_hint=(1, None), height=60)
         self.message_input = TextInput(hint_text='Enter your message', size_hint=(4 / 5, None), size_hint_y=None,
                                        height=60)
@@ -101,45 +233,169 @@ class MessageScreen(Screen):
         go_back_button = Button(text="Go back", size_hint=(0.2, None), pos_hint={'x': 0.1, 'top': 0.9},
                                 color=[0, 0, 0, 1], height=60, on_release=self.go_back)
         self.layout.add_widget(go_back_button)
-        self.layout.add_widget(self.scroll_view)
+        self.layout.add_widget(self.message_list)
         self.layout.add_widget(send_layout)
         self.add_widget(self.layout)
 
     def check_scroll(self, instance, value):
-        if value <= 0 and not self.is_loading and self.has_new_messages:
-            self.is_loading = True
-            thread_id = self.database_manager.get_thread_id(self.sender_id, self.receiver_id)
-            self.update_messages(self.sender_id, self.receiver_id, thread_id)
+        # Scrolled to the top: load the previous page
+        if value >= 1 and not self.is_loading and self.has_older_messages:
+            self.load_older_messages()
 
     def send_message(self, instance):
         message = self.message_input.text
         if message:
-            timestamp = datetime.now()
-            sender = "You"
-            thread_id = self.database_manager.get_thread_id(self.sender_id, self.receiver_id)
-            if thread_id is None:
-                thread_id = self.database_manager.create_new_thread_id()
-            self.message_manager.send_message(self.sender_id, self.receiver_id, message, thread_id)
             self.message_input.text = ''
-            self.update_messages(self.sender_id, self.receiver_id, thread_id)  # Update messages after sending
-            self.has_new_messages = True
+            database_worker.submit(self.post_message, self.sender_id, self.receiver_id, message,
+                                   on_done=self.on_message_sent)
+
+    def post_message(self, sender_id, receiver_id, message):
+        # Database thread
+        thread_id = self.database_manager.get_or_create_thread_id(sender_id, receiver_id)
+        self.message_manager.send_message(sender_id, receiver_id, message, thread_id)
+        return thread_id
+
+    def on_message_sent(self, thread_id):
+        self.thread_id = thread_id
+        # Only append what's new instead of reloading the conversation
+        self.load_new_messages()
+
+    def fetch_messages(self, thread_id, sender_id, receiver_id, before=None, after=None, mark_read=False):
+        # Database thread: a page of messages and the usernames of their senders (from the user
+        # directory, which the page itself has just filled).
+        # With after, every message newer than it, not just one page.
+        if mark_read:
+            self.database_manager.mark_conversation_read(sender_id, receiver_id)
+        messages = self.message_manager.get_messages_page(thread_id, sender_id, receiver_id, before=before,
+                                                          after=after)
+        while after is not None and messages and len(messages) % MESSAGE_PAGE_SIZE == 0:
+            page = self.message_manager.get_messages_page(thread_id, sender_id, receiver_id,
+                                                          after=(messages[-1][3], messages[-1][0]))
+            messages += page
+            if len(page) < MESSAGE_PAGE_SIZE:
+                break
+        usernames = {sender: self.database_manager.fetch_username(sender)
+                     for sender in {message[1] for message in messages} if sender != self.user_id}
+        return messages, usernames
+
+    def load_messages(self, on_loaded, before=None, after=None, mark_read=False):
+        # Fetch on the database thread; dropped if another conversation was opened meanwhile
+        conversation = self.conversation
+
+        def loaded(result):
+            if conversation == self.conversation:
+                self.usernames.update(result[1])
+                on_loaded(result[0])
+
+        database_worker.submit(self.fetch_messages, self.thread_id, self.sender_id, self.receiver_id, before, after,
+                               mark_read, on_done=loaded)
 
     def update_messages(self, sender_id, receiver_id, thread_id):
-        self.messages.clear()
-        self.message_list.clear_widgets()
-        thread_id = self.database_manager.get_thread_id(self.sender_id, self.receiver_id)
-        messages = self.message_manager.get_messages(self.thread_id, self.sender_id, self.receiver_id)
-        new_messages = [msg for msg in messages if msg not in self.messages]
-        self.messages = messages
-
-        for message in new_messages:
-            sender = "You" if message[1] == self.user_id else self.database_manager.fetch_username(message[1])
-            timestamp = datetime.strptime(message[3], '%Y-%m-%d %H:%M:%S.%f')
-            message_bubble = MessageBubble(message_id=message[0], sender=sender, message=message[2],
-                                           timestamp=timestamp, delete_callback=self.message_manager.delete_message)
-            self.message_list.add_widget(message_bubble)
+        # (Re)open the conversation on its latest page
+        if thread_id is not None:
+            self.thread_id = thread_id
+        self.conversation += 1
+        self.clear_message_list()
+        self.is_loading = True
+        self.load_messages(self.on_latest_messages, mark_read=True)
+
+    def on_latest_messages(self, messages):
+        self.has_older_messages = len(messages) == MESSAGE_PAGE_SIZE
+        self.add_messages(messages)
+        self.message_list.scroll_y = 0
         self.is_loading = False
-        self.has_new_messages = False
+
+    def load_older_messages(self):
+        self.is_loading = True
+        self.load_messages(self.on_older_messages, before=self.oldest_key)
+
+    def on_older_messages(self, messages):
+        self.has_older_messages = len(messages) == MESSAGE_PAGE_SIZE
+        if not messages:
+            self.is_loading = False
+            return
+        layout = self.message_list.layout_manager
+        old_height = layout.height
+        self.add_messages(messages, at_top=True)
+
+        def keep_position(dt):
+            # Stay on the message that was at the top before the older ones were added
+            scrollable = layout.height - self.message_list.height
+            if scrollable > 0:
+                self.message_list.scroll_y = max(0, 1 - (layout.height - old_height) / scrollable)
+            self.is_loading = False
+
+        Clock.schedule_once(keep_position, 0)
+
+    def load_new_messages(self, mark_read=False):
+        if self.newest_key is None:
+            self.update_messages(self.sender_id, self.receiver_id, self.thread_id)
+            return
+        self.load_messages(self.on_new_messages, after=self.newest_key, mark_read=mark_read)
+
+    def on_feed_changes(self, changes):
+        # Messages sent or deleted in the open conversation, possibly by another app instance
+        if self.manager is None or self.manager.current != self.name or self.thread_id is None:
+            return
+        if changes is None:
+            # Missed changes, the conversation is reloaded
+            self.update_messages(self.sender_id, self.receiver_id, self.thread_id)
+            return
+        changes = [change for change in changes if change[3] == self.thread_id]
+        for seq, change, message_id, thread_id, sender_id, receiver_id in changes:
+            if change == 'delete':
+                self.on_message_deleted(message_id)
+        if any(change[1] == 'insert' for change in changes):
+            # Only the newer messages are fetched, and they're read since they're on screen
+            self.load_new_messages(mark_read=True)
+
+    def on_new_messages(self, messages):
+        # Another load may have appended some of them already
+        if self.newest_key is not None:
+            messages = [message for message in messages if (message[3], message[0]) > self.newest_key]
+        self.add_messages(messages)
+        self.message_list.scroll_y = 0
+
+    def add_messages(self, messages, at_top=False):
+        if not messages:
+            return
+        rows = [self.message_row(message) for message in messages]
+        if at_top:
+            self.messages[:0] = messages
+            self.message_list.data = rows + self.message_list.data
+        else:
+            self.messages.extend(messages)
+            self.message_list.data.extend(rows)
+        self.oldest_key = (self.messages[0][3], self.messages[0][0])
+        self.newest_key = (self.messages[-1][3], self.messages[-1][0])
+
+    def message_row(self, message):
+        # The data the RecycleView needs to show a message
+        message_id, sender_id, text, timestamp = message
+        sender = "You" if sender_id == self.user_id else self.usernames.get(sender_id)
+        timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
+        text_height = self.text_heights.get(message_id)
+        if text_height is None:
+            text_height = self.text_heights[message_id] = measure_message_height(text)
+        return {'message_id': message_id, 'sender': sender, 'message': text,
+                'timestamp': f"{timestamp.strftime('%H:%M')} {timestamp.strftime('%d/%m/%Y')}",
+                'text_height': text_height, 'height': text_height + ROW_EXTRA_HEIGHT,
+                'delete_callback': self.delete_message}
+
+    def delete_message(self, message_id):
+        database_worker.submit(self.message_manager.delete_message, message_id,
+                               on_done=lambda deleted: deleted and self.on_message_deleted(message_id))
+
+    def on_message_deleted(self, message_id):
+        self.messages = [message for message in self.messages if message[0] != message_id]
+        self.message_list.data = [row for row in self.message_list.data if row['message_id'] != message_id]
+        self.text_heights.pop(message_id, None)
+
+    def clear_message_list(self):
+        self.messages.clear()
+        self.message_list.data = []
+        self.text_heights.clear()
+        self.oldest_key = self.newest_key = None
 
     def open_new_chat(self, sender_id, receiver_id):
         self.sender_id = sender_id
@@ -149,8 +405,7 @@ class MessageScreen(Screen):
         self.update_messages(sender_id, receiver_id, self.thread_id)
 
     def clear_messages(self):
-        self.messages.clear()
-        self.message_list.clear_widgets()
+        self.clear_message_list()
         self.thread_id = None
 
     def go_back(self, instance):
@@ -173,13 +428,8 @@ class UserListScreen(Screen):
         refresh_button = Button(text="Refresh", size_hint=(0.2, None), pos_hint={'x': 0.8, 'top': 0.8})
         refresh_button.bind(on_press=self.refresh)
         self.layout.add_widget(refresh_button)
-        self.user_list = BoxLayout(orientation='vertical', size_hint_y=None)
-        self.user_list.bind(minimum_height=self.user_list.setter('height'))
-        scroll_view = ScrollView()
-        scroll_view.add_widget(self.user_list)
-        self.layout.add_widget(scroll_view)
-        self.user_list.data = [{'text': user[1], 'id': user[0]} for user in self.database_manager.get_users(
-            current_user_id=self.current_user_id)]
+        self.user_list = UserList()
+        self.layout.add_widget(self.user_list)
         self.add_widget(self.layout)
 
     def on_pre_enter(self):
@@ -189,18 +439,43 @@ class UserListScreen(Screen):
         self.update_user_list()
 
     def update_user_list(self):
-        users = self.database_manager.get_users(current_user_id=self.current_user_id)
-        self.user_list.clear_widgets()
-        for user in users:
-            label = UserLabel(user[1], user[0], self)
-            self.user_list.add_widget(label)
+        # Entering the screen and pressing Refresh at the same time only queries once
+        database_worker.submit(self.database_manager.get_conversations, self.current_user_id,
+                               key=('conversations', self.current_user_id), on_done=self.show_conversations)
+
+    def on_feed_changes(self, changes):
+        # New messages received (or missed changes): the list is refreshed for their unread counts
+        # if it's on screen, otherwise on_pre_enter does it
+        received = changes is None or [change for change in changes
+                                       if change[1] == 'insert' and change[5] == self.current_user_id]
+        if received and self.manager is not None and self.manager.current == self.name:
+            self.update_user_list()
+
+    def show_conversations(self, conversations):
+        self.user_list.data = [{'user_id': partner_id, 'thread_id': thread_id, 'user_list_screen': self,
+                                'text': self.conversation_text(username, last_message_at, unread_count)}
+                               for partner_id, username, thread_id, last_message_at, unread_count in conversations]
+
+    def conversation_text(self, username, last_message_at, unread_count):
+        text = escape_markup(username)
+        if unread_count:
+            text = f"[b]{text} ({unread_count})[/b]"
+        if last_message_at:
+            timestamp = datetime.strptime(last_message_at, '%Y-%m-%d %H:%M:%S.%f')
+            text += f"\n[size=12sp]{timestamp.strftime('%H:%M')} {timestamp.strftime('%d/%m/%Y')}[/size]"
+        return text
+
+    def user_selected(self, user_id, thread_id=None):
+        if thread_id is not None:
+            self.open_conversation(user_id, thread_id)
+            return
+        database_worker.submit(self.database_manager.get_or_create_thread_id, self.current_user_id, user_id,
+                               on_done=lambda thread_id: self.open_conversation(user_id, thread_id))
 
-    def user_selected(self, user_id):
+    def open_conversation(self, user_id, thread_id):
         message_screen = self.screen_manager.get_screen('message_screen')
         message_screen.receiver_id = user_id
-        self.thread_id = self.database_manager.get_thread_id(self.current_user_id, user_id)
-        if self.thread_id is None:
-            self.thread_id = self.database_manager.create_new_thread_id()
+        self.thread_id = thread_id
         message_screen.thread_id = self.thread_id
         message_screen.sender_id = self.current_user_id
         message_screen.update_messages(message_screen.sender_id, message_screen.receiver_id, self.thread_id)
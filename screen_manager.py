@@ -21,14 +21,20 @@ class MyApp(App):
         self.user_id = None
         self.username = None
         self.key = None
-
+        self.message_feed = None
 
     def build(self):
+        from main import start_coordinate_backfill
+        from tile_store import start_cache_import
+        # Geocode the comments that don't have coordinates yet, off the UI thread
+        start_coordinate_backfill()
+        # Pack the loose map tiles of the old cache/ directory the first time
+        start_cache_import()
         return create_screen_manager()
 
     def on_login_success(self, user_id, username, key):
         from main import LoginScreen, DatabaseManager, MainScreen, SecondScreen, ThirdScreen
-        from messagescreen import MessageScreen, UserListScreen
+        from messagescreen import MessageFeedPoller, MessageScreen, UserListScreen
         from settings import SettingsScreen
         self.user_id = user_id
         self.username = username
@@ -58,6 +64,13 @@ class MyApp(App):
         self.root.add_widget(third_screen)
         self.root.add_widget(settings_screen)
         self.root.current = 'main'
+        # Deliver incoming messages to the message screens while the user is logged in
+        if self.message_feed is not None:
+            self.message_feed.stop()
+        self.message_feed = MessageFeedPoller(message_manager)
+        self.message_feed.add_listener(message_screen.on_feed_changes)
+        self.message_feed.add_listener(user_list_screen.on_feed_changes)
+        self.message_feed.start()
 
 
 if __name__ == '__main__':
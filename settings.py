@@ -4,6 +4,7 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.app import App
 from main import RoundedButton, DatabaseManager, BaseScreen
+from background_tasks import database_worker
 from kivy.uix.popup import Popup
 from bcrypt import gensalt, hashpw
 from kivy.uix.label import Label
@@ -97,23 +98,23 @@ class SettingsScreen(BaseScreen):
             return
 
         user_id = App.get_running_app().user_id  # Get the user ID
-        db_manager = DatabaseManager('comments.db')
-        db_manager.update_user(user_id, new_username, None)  # Update the username
-        db_manager.close()
-        self.show_message('Success', 'Username changed successfully')  # Show a message to the user
+        database_worker.submit(self.db_manager.update_user, user_id, new_username, None,  # Update the username
+                               on_done=lambda result: self.show_message('Success', 'Username changed successfully'))
 
     def change_password(self, instance):
         new_password = self.password_input.text
+        user_id = App.get_running_app().user_id  # Get the user ID
+        database_worker.submit(self.save_password, user_id, new_password,
+                               on_done=lambda result: self.show_message('Success', 'Password changed successfully'))
+
+    def save_password(self, user_id, new_password):
+        # Database thread, bcrypt is slow on purpose
         # Generate a unique salt for each user
         salt = gensalt()
         # Hash the password with the salt
         hashed_password = hashpw(new_password.encode('utf-8'), salt)
         hashed_password = binascii.hexlify(hashed_password).decode('utf-8')
-        user_id = App.get_running_app().user_id  # Get the user ID
-        db_manager = DatabaseManager('comments.db')
-        db_manager.update_user(user_id, None, hashed_password)  # Update the password with the hashed one
-        db_manager.close()
-        self.show_message('Success', 'Password changed successfully')  # Show a message to the user
+        self.db_manager.update_user(user_id, None, hashed_password)  # Update the password with the hashed one
 
     def confirm_delete_account(self, instance):
         box = BoxLayout(orientation='vertical')
@@ -129,7 +130,7 @@ class SettingsScreen(BaseScreen):
 
     def delete_account(self, instance):
         user_id = App.get_running_app().user_id
-        self.db_manager.delete_user(user_id)
+        database_worker.submit(self.db_manager.delete_user, user_id)
         self.manager.current = 'login'
         self.username_input.text = ''
         self.password_input.text = ''
@@ -137,7 +138,7 @@ class SettingsScreen(BaseScreen):
     def on_privacy_button_release(self, instance):
         self.is_private = not self.is_private
         user_id = App.get_running_app().user_id
-        self.db_manager.update_privacy_mode(user_id, self.is_private)
+        database_worker.submit(self.db_manager.update_privacy_mode, user_id, self.is_private)
 
         if self.is_private:
             self.privacy_button.text = 'Switch to Public Mode'
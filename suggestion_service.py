@@ -0,0 +1,178 @@
+import logging
+import sqlite3
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+import requests
+
+from background_tasks import BackgroundTask, database_worker
+from database_service import get_database_service
+from gazetteer import get_gazetteer
+from geocode_cache import normalize_location
+
+
+# Suggestions shown at most, remote answers kept in memory, and locations of past comments loaded
+MAX_SUGGESTIONS = 10
+CACHE_SIZE = 500
+KNOWN_LOCATIONS = 5000
+
+# Longest text suggestions are looked up for
+MAX_QUERY_LENGTH = 150
+
+SUGGESTIONS_URL = 'https://api.opencagedata.com/geocode/v1/json'
+
+
+class SuggestionService:
+    # Location suggestions for what the user is typing. Locations already used in comments the
+    # user can see come from memory with a prefix search; the rest comes from the local gazetteer
+    # and, for what it doesn't know, OpenCage, on a worker thread, answers cached by query.
+    # Only the latest request of a caller is answered.
+    def __init__(self, api_key, db_path='comments.db', cache_size=CACHE_SIZE):
+        self.api_key = api_key
+        self.db = get_database_service(db_path)
+        self.gazetteer = get_gazetteer()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # normalized query -> formatted results, most recently used last
+        self.cache = OrderedDict()
+        # Sorted (key, location) of the locations used so far, per user. A location has a key from
+        # each word on, so "Ramat Gan, Israel" is found typing "ram", "gan" or "isr".
+        self.known = []
+        self.known_user_id = None
+        # caller -> its running request
+        self.tasks = {}
+
+    def load_known_locations(self, user_id):
+        # Database thread: the sorted index of the most used locations of the comments this user can see
+        rows = self.db.fetchall("""
+            SELECT location FROM comments
+            WHERE location IS NOT NULL AND location != '' AND (is_private = 0 OR user_id = ?)
+            GROUP BY location ORDER BY COUNT(*) DESC LIMIT ?
+        """, (user_id, KNOWN_LOCATIONS))
+        return user_id, sorted({entry for row in rows for entry in location_keys(row[0])})
+
+    def on_known_locations(self, result):
+        user_id, known = result
+        with self.lock:
+            self.known = known
+            self.known_user_id = user_id
+
+    def prepare(self, user_id):
+        # Loads the known locations of this user if they aren't already
+        if user_id != self.known_user_id:
+            database_worker.submit(self.load_known_locations, user_id, key=('known_locations', user_id),
+                                   on_done=self.on_known_locations)
+
+    def remember(self, location):
+        # A location the user picked or published, suggested from memory from now on
+        entries = location_keys(location)
+        with self.lock:
+            for entry in entries:
+                index = bisect_left(self.known, entry)
+                if index == len(self.known) or self.known[index] != entry:
+                    insort(self.known, entry, lo=index)
+
+    def known_matches(self, query):
+        # Known locations with a word starting with query, a prefix range of the sorted list
+        with self.lock:
+            index = bisect_left(self.known, (query, ''))
+            matches = []
+            while index < len(self.known) and self.known[index][0].startswith(query) \
+                    and len(matches) < MAX_SUGGESTIONS:
+                if self.known[index][1] not in matches:
+                    matches.append(self.known[index][1])
+                index += 1
+        return matches
+
+    def cached(self, query):
+        with self.lock:
+            results = self.cache.get(query)
+            if results is not None:
+                self.cache.move_to_end(query)
+            return results
+
+    def suggest(self, text, on_results, caller=None, remote=True):
+        # Calls on_results(text, suggestions) on the main thread: right away from memory, or once
+        # the gazetteer or the remote answer arrives (no remote request if remote is False). A newer
+        # call from the same caller cancels its pending request. Returns True if answered from memory.
+        self.cancel(caller)
+        query = normalize_location(text)
+        if not query or len(query) > MAX_QUERY_LENGTH:
+            on_results(text, [])
+            return True
+        results = self.cached(query)
+        if results is None:
+            results = self.known_matches(query) or None
+        if results is not None:
+            on_results(text, results)
+            return True
+        self.tasks[caller] = BackgroundTask(self.lookup, query, remote,
+                                            on_done=lambda results: self.on_fetched(caller, text, results,
+                                                                                    on_results)).start()
+        return False
+
+    def lookup(self, task, query, remote):
+        # Worker thread: the gazetteer first, OpenCage only for the places it doesn't have
+        try:
+            results = self.gazetteer.suggest(query, MAX_SUGGESTIONS)
+        except sqlite3.Error as e:
+            logging.error(f"Gazetteer lookup failed for location '{query}': {e}")
+            results = []
+        if results:
+            self.cache_results(query, results)
+            return results
+        if remote and not task.is_cancelled:
+            # A failed request answers "nothing", so the suggestions of an older text don't stay up
+            return self.fetch(query) or []
+        return None
+
+    def fetch(self, query):
+        try:
+            response = requests.get(SUGGESTIONS_URL, params={'q': query, 'key': self.api_key,
+                                                            'limit': MAX_SUGGESTIONS, 'no_annotations': 1},
+                                    timeout=5)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logging.error(f"Failed to get suggestions for location '{query}': {e}")
+            return None
+        results = [result['formatted'] for result in data.get('results', [])]
+        self.cache_results(query, results)
+        return results
+
+    def cache_results(self, query, results):
+        with self.lock:
+            self.cache[query] = results
+            self.cache.move_to_end(query)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def on_fetched(self, caller, text, results, on_results):
+        self.tasks.pop(caller, None)
+        if results is not None:
+            on_results(text, results)
+
+    def cancel(self, caller=None):
+        task = self.tasks.pop(caller, None)
+        if task is not None:
+            task.cancel()
+
+
+def location_keys(location):
+    # (key, location) entries of the known locations index, a key from each word on
+    normalized = normalize_location(location)
+    return [(normalized[start:], location) for start in range(len(normalized))
+            if (start == 0 or normalized[start - 1] in ' ,') and normalized[start] not in ' ,']
+
+
+# One service per database file, shared by every location input
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_suggestion_service(api_key, db_path='comments.db'):
+    with _services_lock:
+        if db_path not in _services:
+            _services[db_path] = SuggestionService(api_key, db_path)
+        return _services[db_path]
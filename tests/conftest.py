@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+from cryptography.fernet import Fernet
+
+# The app's modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Read when the app's modules are imported: kivy must leave pytest's arguments alone
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+os.environ.setdefault('ENCRYPTION_KEY', Fernet.generate_key().decode())
+
+from database_schema import migrate  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'comments.db')
+
+
+@pytest.fixture
+def conn(db_path):
+    # A fresh database with every migration applied
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def main_module(tmp_path_factory):
+    # main.py opens comments.db (and the other app files) in the working directory when imported,
+    # keep them away from the repository's
+    os.chdir(tmp_path_factory.mktemp('app'))
+    import main
+    return main
@@ -0,0 +1,35 @@
+import os
+
+
+def count(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_insert_comments_bulk_indexes_every_row(main_module, conn, db_path):
+    conn.execute("INSERT INTO users (id, username, password) VALUES (1, 'alice', 'x')")
+    conn.commit()
+    comments = [(1, 'Joy', f"comment {number}", 'Paris', number % 5 == 0, 0, 48.85 + number / 1000, 2.35)
+                for number in range(50)]
+    comments.append((1, 'Joy', 'not geocoded yet', 'Nowhere', 0, 0))
+    assert main_module.DatabaseManager(db_path).insert_comments_bulk(comments) == 51
+    assert count(conn, 'comments') == 51
+    # Encrypted (private) comments stay out of the full-text index, comments without coordinates out of the R*Tree
+    # comments_fts reads its text from comments, its shadow table has a row per indexed comment
+    assert count(conn, 'comments_fts_docsize') == 41
+    assert count(conn, 'comments_rtree') == 50
+    assert conn.execute("SELECT COUNT(*) FROM comments_fts WHERE comments_fts MATCH 'geocoded'").fetchone()[0] == 1
+
+
+def test_group_commit_fires_message_triggers_per_row(conn, db_path):
+    from comments_manager import SEND_MESSAGE, MessageManager
+    from database_service import get_database_service
+
+    manager = MessageManager(1, 'alice', os.environ['ENCRYPTION_KEY'], db_path=db_path)
+    writer = get_database_service(db_path).group_commit()
+    for number in range(20):
+        writer.add(SEND_MESSAGE, manager.message_row(1, 2, f"message {number}", 1))
+    # The writer thread may already have committed some of them
+    writer.flush()
+    assert count(conn, 'messages') == 20
+    assert count(conn, 'message_feed') == 20
+    assert conn.execute("SELECT unread_count FROM conversations WHERE user_id = 2 AND partner_id = 1").fetchone()[0] == 20
@@ -0,0 +1,81 @@
+import pytest
+
+from comment_search import private_comment_index
+
+
+@pytest.fixture
+def manager(main_module, conn, db_path):
+    # No private search index of another test holds the pruning back
+    private_comment_index.clear()
+    yield main_module.DatabaseManager(db_path)
+    private_comment_index.clear()
+
+
+def add_comment(conn, lat=None, lon=None):
+    with conn:
+        return conn.execute("INSERT INTO comments (user_id, topic, comment, location, is_private, lat, lon) "
+                            "VALUES (1, 'Topic: Joy', 'hello', 'Paris', 0, ?, ?)", (lat, lon)).lastrowid
+
+
+def update(conn, comment_id, column, value):
+    with conn:
+        conn.execute(f"UPDATE comments SET {column} = ? WHERE id = ?", (value, comment_id))
+
+
+def logged_ids(conn):
+    return [row[0] for row in conn.execute("SELECT comment_id FROM comment_changes ORDER BY seq")]
+
+
+def test_first_coordinates_are_not_logged(manager, conn):
+    comment_id = add_comment(conn)
+    manager.update_comment_coordinates(comment_id, 48.85, 2.35)
+    assert logged_ids(conn) == []
+    # Moving a placed comment is a change the map has to apply
+    manager.update_comment_coordinates(comment_id, 45.76, 4.83)
+    update(conn, comment_id, 'topic', 'Topic: Love')
+    assert logged_ids(conn) == [comment_id, comment_id]
+
+
+def test_backfill_counts_the_comments_it_geocodes(main_module, manager, conn):
+    class Geocoder:
+        def get_location_coordinates(self, location):
+            return {'lat': 48.85, 'lng': 2.35}
+
+    add_comment(conn)
+    add_comment(conn)
+    geocoded = main_module.geocoded_comments()
+    assert manager.backfill_coordinates(Geocoder()) == 2
+    assert main_module.geocoded_comments() == geocoded + 2
+    assert logged_ids(conn) == []
+
+
+def test_pruned_changes_are_reported_as_missed(manager, conn):
+    comment_id = add_comment(conn, 48.85, 2.35)
+    for topic in ('Topic: Love', 'Topic: Fear', 'Topic: Joy'):
+        update(conn, comment_id, 'topic', topic)
+    assert manager.get_comment_changes(0) == (3, {comment_id})
+    assert manager.prune_comment_changes(2) == 2
+    assert manager.get_comment_changes(0) == (3, None)
+    assert manager.get_comment_changes(1) == (3, None)
+    assert manager.get_comment_changes(2) == (3, {comment_id})
+    assert manager.get_comment_changes(3) == (3, set())
+
+
+def test_pruning_keeps_the_latest_change(manager, conn):
+    comment_id = add_comment(conn, 48.85, 2.35)
+    update(conn, comment_id, 'topic', 'Topic: Love')
+    update(conn, comment_id, 'topic', 'Topic: Fear')
+    assert manager.prune_comment_changes(100) == 1
+    assert manager.get_last_change_seq() == 2
+
+
+def test_pruning_waits_for_the_private_search_index(manager, conn):
+    comment_id = add_comment(conn, 48.85, 2.35)
+    update(conn, comment_id, 'topic', 'Topic: Love')
+    # The index of user 1 has applied the first change only
+    with private_comment_index.lock:
+        private_comment_index.update(1, [], set(), comment_id, 1)
+    update(conn, comment_id, 'topic', 'Topic: Fear')
+    update(conn, comment_id, 'topic', 'Topic: Joy')
+    assert manager.prune_comment_changes(3) == 1
+    assert manager.get_comment_changes(1) == (3, {comment_id})
@@ -0,0 +1,66 @@
+from message_queries import MARK_CONVERSATION_READ
+
+ALICE, BOB = 1, 2
+
+
+def send(conn, sender_id, receiver_id, text='hi'):
+    with conn:
+        return conn.execute("INSERT INTO messages (sender_id, receiver_id, message, thread_id) VALUES (?, ?, ?, 1)",
+                            (sender_id, receiver_id, text)).lastrowid
+
+
+def delete(conn, message_id):
+    with conn:
+        conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+
+
+def unread_count(conn, user_id, partner_id):
+    row = conn.execute("SELECT unread_count FROM conversations WHERE user_id = ? AND partner_id = ?",
+                       (user_id, partner_id)).fetchone()
+    return row[0] if row else None
+
+
+def mark_read(conn, user_id, partner_id):
+    with conn:
+        conn.execute(MARK_CONVERSATION_READ, (user_id, partner_id))
+
+
+def test_deleting_an_unread_message_decrements_unread_count(conn):
+    ids = [send(conn, ALICE, BOB) for _ in range(3)]
+    assert unread_count(conn, BOB, ALICE) == 3
+    delete(conn, ids[1])
+    assert unread_count(conn, BOB, ALICE) == 2
+    delete(conn, ids[2])
+    assert unread_count(conn, BOB, ALICE) == 1
+
+
+def test_deleting_a_read_message_keeps_unread_count(conn):
+    read_id = send(conn, ALICE, BOB)
+    mark_read(conn, BOB, ALICE)
+    unread_id = send(conn, ALICE, BOB)
+    send(conn, BOB, ALICE)
+    assert unread_count(conn, BOB, ALICE) == 1
+    delete(conn, read_id)
+    assert unread_count(conn, BOB, ALICE) == 1
+    delete(conn, unread_id)
+    assert unread_count(conn, BOB, ALICE) == 0
+
+
+def test_deleting_a_sent_message_keeps_the_senders_count(conn):
+    send(conn, BOB, ALICE)
+    sent_id = send(conn, ALICE, BOB)
+    delete(conn, sent_id)
+    assert unread_count(conn, ALICE, BOB) == 1
+    assert unread_count(conn, BOB, ALICE) == 0
+
+
+def test_reused_message_id_counts_as_unread(conn):
+    send(conn, ALICE, BOB)
+    last_id = send(conn, ALICE, BOB)
+    mark_read(conn, BOB, ALICE)
+    delete(conn, last_id)
+    # messages.id isn't AUTOINCREMENT, the next message gets the deleted one's id
+    assert send(conn, ALICE, BOB) == last_id
+    assert unread_count(conn, BOB, ALICE) == 1
+    delete(conn, last_id)
+    assert unread_count(conn, BOB, ALICE) == 0
@@ -0,0 +1,113 @@
+import os
+import time
+
+import pytest
+
+import database_service
+from database_service import MainThreadIOMonitor
+
+# How long a screen gets to finish what it queued on the worker threads, in seconds
+SETTLE_TIMEOUT = 10
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    # Any database call the screens make on the (pytest) main thread raises
+    monitor = MainThreadIOMonitor(raise_on_io=True)
+    monkeypatch.setattr(database_service, 'main_thread_io', monitor)
+    return monitor
+
+
+@pytest.fixture
+def app(main_module):
+    from kivy import kivy_data_dir
+    from kivy.core.text import LabelBase
+    from kivy.resources import resource_add_path
+    from screen_manager import MyApp, create_screen_manager
+    # The screens' fonts and images, the working directory is the test's
+    resource_add_path(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # Kivy's bundled DejaVuSans.ttf, which "dejavusans" only finds on case-insensitive file systems
+    LabelBase.register('dejavusans', os.path.join(kivy_data_dir, 'fonts', 'DejaVuSans.ttf'))
+    app = MyApp()
+    app.root = create_screen_manager()
+    yield app
+    if app.message_feed is not None:
+        app.message_feed.stop()
+
+
+def pump(until):
+    # Runs the Kivy clock, which delivers the worker threads' results, until until() is true
+    from kivy.clock import Clock
+    deadline = time.monotonic() + SETTLE_TIMEOUT
+    while not until():
+        assert time.monotonic() < deadline, "the screen never got its results"
+        Clock.tick()
+        time.sleep(0.01)
+    # The callbacks scheduled by the last results
+    for _ in range(10):
+        Clock.tick()
+
+
+def drain():
+    # The database thread runs its calls in order: once this one is done, so are the earlier ones
+    from background_tasks import database_worker
+    done = []
+    database_worker.submit(lambda: None, on_done=done.append)
+    pump(lambda: done)
+
+
+def test_screens_never_touch_the_database_on_the_main_thread(monitor, app):
+    screens = app.root
+
+    # Login: sign up two users, then sign in as the second
+    login = screens.get_screen('login')
+    for username in ('bob', 'alice'):
+        screens.current = 'login'
+        login.username.text = username
+        login.password.text = login.confirm_password.text = 'secret'
+        login.sign_up(None)
+        pump(lambda: screens.current == 'main')
+        if username == 'bob':
+            bob_id = app.user_id
+    screens.current = 'login'
+    login.sign_in(None)
+    pump(lambda: app.message_feed is not None)
+    assert screens.current == 'main'
+
+    # Publish
+    second = screens.get_screen('second')
+    second.topic = 'Joy'
+    second.text_input.text = 'A comment'
+    screens.current = 'second'
+    second.publish(None)
+    pump(lambda: screens.current == 'third')
+
+    # Map: the visit publishing switched to, then a search
+    third = screens.get_screen('third')
+    pump(lambda: third.cluster_index is not None)
+    third.search_bar.text = 'comment'
+    third.on_search_button_press(None)
+    pump(lambda: third.search_results)
+
+    # Messages
+    user_list = screens.get_screen('UserList')
+    user_list.user_selected(bob_id)
+    pump(lambda: screens.current == 'message_screen')
+    message_screen = screens.get_screen('message_screen')
+    message_screen.message_input.text = 'hi'
+    message_screen.send_message(None)
+    pump(lambda: message_screen.messages)
+    app.message_feed.poll()
+    user_list.refresh(None)
+    pump(lambda: user_list.user_list.data)
+
+    # Settings
+    settings = screens.get_screen('settings')
+    settings.on_privacy_button_release(None)
+    settings.username_input.text = 'alice2'
+    settings.change_username(None)
+    settings.password_input.text = 'secret2'
+    settings.change_password(None)
+    drain()
+
+    assert monitor.stats()['calls'] == 0
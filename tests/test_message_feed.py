@@ -0,0 +1,41 @@
+import os
+
+from comments_manager import MessageManager
+
+ALICE, BOB, CAROL = 1, 2, 3
+
+
+def manager(user_id, db_path):
+    # One per app instance, both on the same database file
+    return MessageManager(user_id, f"user{user_id}", os.environ['ENCRYPTION_KEY'], db_path=db_path)
+
+
+def test_poll_since_returns_only_new_changes(db_path):
+    alice, bob = manager(ALICE, db_path), manager(BOB, db_path)
+    changes, seq = bob.poll_since(None)
+    assert changes == []
+    message_id = alice.send_message(ALICE, BOB, 'hi', 1)
+    alice.send_message(ALICE, CAROL, 'not for bob', 2)
+    changes, new_seq = bob.poll_since(seq)
+    assert [(change[1], change[2]) for change in changes] == [('insert', message_id)]
+    assert new_seq > seq
+    assert bob.poll_since(new_seq) == ([], new_seq)
+
+
+def test_poll_since_reports_pruned_changes(db_path):
+    alice, bob = manager(ALICE, db_path), manager(BOB, db_path)
+    _, seq = bob.poll_since(None)
+    alice.send_message(ALICE, BOB, 'first', 1)
+    _, first_seq = alice.poll_since(None)
+    alice.send_message(ALICE, BOB, 'second', 1)
+    alice.prune_feed(first_seq)
+    changes, _ = bob.poll_since(seq)
+    assert changes is None
+
+
+def test_prune_feed_keeps_the_latest_change(db_path):
+    alice, bob = manager(ALICE, db_path), manager(BOB, db_path)
+    alice.send_message(ALICE, BOB, 'hi', 1)
+    _, seq = bob.poll_since(None)
+    assert alice.prune_feed(seq) == 0
+    assert bob.poll_since(seq) == ([], seq)
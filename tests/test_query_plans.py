@@ -0,0 +1,12 @@
+import pytest
+
+from message_queries import HOT_QUERIES, audit_query_plans
+
+
+def test_no_hot_query_scans_a_table(conn):
+    assert audit_query_plans(conn) == []
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_an_index(conn, name):
+    assert [detail for query_name, detail in audit_query_plans(conn) if query_name == name] == []
@@ -0,0 +1,377 @@
+import io
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from random import choice
+
+import requests
+from kivy.core.image import Image as CoreImage
+from kivy_garden.mapview.downloader import Downloader, USER_AGENT
+from kivy_garden.mapview.source import MapSource
+
+from background_tasks import BackgroundTask
+
+
+# One packed file holds every map tile (MBTiles layout: tiles(zoom_level, tile_column, tile_row, tile_data)
+# with a TMS row, which is also how MapView numbers tile_y)
+TILE_STORE_PATH = 'tiles.mbtiles'
+
+# Once the tiles take more than this, the least recently used are evicted down to EVICT_TO of it
+MAX_BYTES = 200 * 1024 * 1024
+EVICT_TO = 0.9
+
+# Reads record when a tile was last used; those updates are written in batches of this size
+TOUCH_BATCH = 64
+
+# Decoded tiles kept as textures, a screen shows about 12 to 30 of them
+TEXTURE_CACHE_SIZE = 256
+
+# Prefetch: rings of neighbouring tiles around the viewport, and how many decoded tiles a worker
+# hands to the main thread at a time
+PREFETCH_RING = 1
+PREFETCH_BATCH = 8
+
+# Loose tile files of the default mapview cache: <cache_key>_<zoom>_<x>_<y>.<ext>
+CACHE_FILE = re.compile(r'^(?P<key>[^_]+)_(?P<zoom>\d+)_(?P<x>\d+)_(?P<y>\d+)\.(?P<ext>\w+)$')
+
+
+class TileStore:
+    # Map tiles in one SQLite file instead of thousands of loose PNGs, capped at max_bytes with
+    # least recently used eviction. Safe to use from the downloader's worker threads.
+    def __init__(self, path=TILE_STORE_PATH, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.write_conn = sqlite3.connect(path, check_same_thread=False)
+        self.write_conn.execute("PRAGMA journal_mode=WAL")
+        self.write_conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+        self.total_bytes = self.write_conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        # (zoom, x, y) -> time, last uses not written yet
+        self.touches = {}
+
+    def create_tables(self):
+        with self.write_lock, self.write_conn:
+            self.write_conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            self.write_conn.execute("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    tile_data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (zoom_level, tile_column, tile_row)
+                ) WITHOUT ROWID
+            """)
+            self.write_conn.execute("CREATE INDEX IF NOT EXISTS idx_tiles_last_used ON tiles (last_used)")
+            self.write_conn.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+                                        [('name', 'Feelings map tiles'), ('format', 'png'), ('type', 'baselayer'),
+                                         ('minzoom', '0'), ('maxzoom', '19')])
+
+    def read_connection(self):
+        # Each thread reads through its own connection
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path)
+        return conn
+
+    def get(self, zoom, x, y):
+        # The tile's image bytes, None if it isn't in the store
+        row = self.read_connection().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, x, y)).fetchone()
+        if row is None:
+            return None
+        with self.write_lock:
+            self.touches[(zoom, x, y)] = time.time()
+            if len(self.touches) >= TOUCH_BATCH:
+                self.write_touches()
+        return bytes(row[0])
+
+    def has(self, zoom, x, y):
+        return self.read_connection().execute(
+            "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, x, y)).fetchone() is not None
+
+    def put(self, zoom, x, y, data):
+        self.put_many([(zoom, x, y, data, time.time())])
+
+    def put_many(self, tiles):
+        # tiles: (zoom, x, y, data, last_used), written in one transaction
+        with self.write_lock:
+            with self.write_conn:
+                for zoom, x, y, data, last_used in tiles:
+                    old = self.write_conn.execute(
+                        "SELECT size FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                        (zoom, x, y)).fetchone()
+                    self.write_conn.execute(
+                        "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, size, last_used) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (zoom, x, y, data, len(data), last_used))
+                    self.total_bytes += len(data) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def write_touches(self):
+        # Called with write_lock held
+        touches, self.touches = self.touches, {}
+        with self.write_conn:
+            self.write_conn.executemany(
+                "UPDATE tiles SET last_used = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                [(last_used, zoom, x, y) for (zoom, x, y), last_used in touches.items()])
+
+    def evict(self):
+        # Called with write_lock held: drop least recently used tiles until under EVICT_TO of the cap
+        self.write_touches()
+        target = self.max_bytes * EVICT_TO
+        with self.write_conn:
+            rows = self.write_conn.execute(
+                "SELECT zoom_level, tile_column, tile_row, size FROM tiles ORDER BY last_used ASC")
+            evicted = []
+            for zoom, x, y, size in rows:
+                if self.total_bytes <= target:
+                    break
+                evicted.append((zoom, x, y))
+                self.total_bytes -= size
+            self.write_conn.executemany(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", evicted)
+        logging.info(f"Evicted {len(evicted)} map tiles, {self.total_bytes} bytes left")
+
+    def flush(self):
+        with self.write_lock:
+            self.write_touches()
+
+    def stats(self):
+        count = self.read_connection().execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        return {'tiles': count, 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+    def import_cache_dir(self, cache_dir='cache', cache_key=None, remove=False, batch_size=200):
+        # Packs the loose tiles of a mapview cache directory (of one map source if cache_key is given).
+        # Their modification time becomes their last use. Returns the number of tiles imported.
+        imported = 0
+        batch = []
+        names = []
+        for name in sorted(os.listdir(cache_dir)):
+            match = CACHE_FILE.match(name)
+            if match is None or (cache_key is not None and match['key'] != cache_key):
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                with open(path, 'rb') as tile_file:
+                    data = tile_file.read()
+                last_used = os.path.getmtime(path)
+            except OSError as e:
+                logging.error(f"Could not read tile {path}: {e}")
+                continue
+            if not data:
+                continue
+            batch.append((int(match['zoom']), int(match['x']), int(match['y']), data, last_used))
+            names.append(path)
+            if len(batch) >= batch_size:
+                self.put_many(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            self.put_many(batch)
+            imported += len(batch)
+        if remove:
+            for path in names:
+                os.remove(path)
+        return imported
+
+
+class TileTextureCache:
+    # Textures of recently shown or prefetched tiles by (zoom, x, y), bounded LRU. Main thread only,
+    # like the textures themselves.
+    def __init__(self, size=TEXTURE_CACHE_SIZE):
+        self.size = size
+        self.textures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        texture = self.textures.get(key)
+        if texture is None:
+            self.misses += 1
+            return None
+        self.textures.move_to_end(key)
+        self.hits += 1
+        return texture
+
+    def put(self, key, texture):
+        self.textures[key] = texture
+        self.textures.move_to_end(key)
+        while len(self.textures) > self.size:
+            self.textures.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.textures
+
+
+class PackedMapSource(MapSource):
+    # MapSource serving tiles from a TileStore. Tiles missing from it are downloaded and packed,
+    # unless offline, in which case they stay blank. Same tile URL and cache key as the default
+    # MapView source, so the packed tiles of the old cache directory are the ones it shows.
+    def __init__(self, tile_store, offline=False, texture_cache_size=TEXTURE_CACHE_SIZE, **kwargs):
+        super(PackedMapSource, self).__init__(**kwargs)
+        self.tile_store = tile_store
+        self.offline = offline
+        self.texture_cache = TileTextureCache(texture_cache_size)
+
+    def fill_tile(self, tile):
+        if tile.state == "done":
+            return
+        # Already decoded (shown before or prefetched): on screen this frame
+        texture = self.texture_cache.get((tile.zoom, tile.tile_x, tile.tile_y))
+        if texture is not None:
+            tile.texture = texture
+            tile.state = "need-animation"
+            return
+        Downloader.instance(self.cache_dir).submit(self._load_tile, tile)
+
+    def tile_data(self, zoom, x, y):
+        # Worker thread: the tile's bytes from the store, downloaded if needed and allowed
+        data = self.tile_store.get(zoom, x, y)
+        if data is not None or self.offline:
+            return data
+        row = self.get_row_count(zoom) - y - 1
+        url = self.url.format(z=zoom, x=x, y=row, s=choice(self.subdomains))
+        try:
+            response = requests.get(url, headers={'User-agent': USER_AGENT}, timeout=5)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            # No network: serve what's packed and leave this tile blank
+            logging.warning(f"Could not download map tile {zoom}/{x}/{row}: {e}")
+            return None
+        data = response.content
+        self.tile_store.put(zoom, x, y, data)
+        return data
+
+    def decode(self, zoom, x, y, data):
+        # Worker thread: decoded here, the texture itself is created on the main thread
+        return CoreImage(io.BytesIO(data), ext=self.image_ext, nocache=True,
+                         filename=f"{zoom}.{x}.{y}.{self.image_ext}")
+
+    def _load_tile(self, tile):
+        if tile.state == "done":
+            return
+        data = self.tile_data(tile.zoom, tile.tile_x, tile.tile_y)
+        if data is None:
+            tile.state = "done"
+            return
+        return self._load_tile_done, (tile, self.decode(tile.zoom, tile.tile_x, tile.tile_y, data))
+
+    def _load_tile_done(self, tile, image):
+        tile.texture = image.texture
+        tile.state = "need-animation"
+        self.texture_cache.put((tile.zoom, tile.tile_x, tile.tile_y), tile.texture)
+
+
+class TilePrefetcher:
+    # Warms the texture cache of a PackedMapSource around what a MapView shows: PREFETCH_RING rings
+    # of neighbouring tiles, the tiles of the next zoom level in, and those of the level out.
+    # Read and decoded on a background worker, turned into textures on the main thread, so panning
+    # or zooming by one step shows tiles that are already there.
+    def __init__(self, map_view, map_source, ring=PREFETCH_RING):
+        self.map_view = map_view
+        self.map_source = map_source
+        self.ring = ring
+        self.task = None
+
+    def wanted_tiles(self):
+        # (zoom, x, y) to have ready, most likely to be needed first
+        map_view = self.map_view
+        source = self.map_source
+        zoom = map_view.zoom
+        vx, vy = map_view.viewport_pos
+        x_first, y_first, x_last, y_last, _, _ = map_view.bbox_for_zoom(vx, vy, map_view.width, map_view.height,
+                                                                        zoom)
+        wanted = []
+        for ring in range(self.ring + 1):
+            for x in range(x_first - ring, x_last + ring):
+                for y in range(y_first - ring, y_last + ring):
+                    on_ring = x in (x_first - ring, x_last + ring - 1) or y in (y_first - ring, y_last + ring - 1)
+                    if ring == 0 or on_ring:
+                        wanted.append((zoom, x, y))
+        if zoom < source.get_max_zoom():
+            wanted += [(zoom + 1, x * 2 + dx, y * 2 + dy) for x in range(x_first, x_last)
+                       for y in range(y_first, y_last) for dx in (0, 1) for dy in (0, 1)]
+        if zoom > source.get_min_zoom():
+            wanted += list(dict.fromkeys((zoom - 1, x // 2, y // 2) for x in range(x_first, x_last)
+                                         for y in range(y_first, y_last)))
+        return [(z, x, y) for z, x, y in wanted
+                if 0 <= x < source.get_col_count(z) and 0 <= y < source.get_row_count(z)]
+
+    def prefetch(self, *args):
+        # Anything still loading was for the previous view
+        self.cancel()
+        missing = [key for key in self.wanted_tiles() if key not in self.map_source.texture_cache]
+        if missing:
+            self.task = BackgroundTask(self.load_tiles, missing, on_batch=self.on_tiles).start()
+
+    def load_tiles(self, task, keys):
+        # Worker thread
+        batch = []
+        for zoom, x, y in keys:
+            if task.is_cancelled:
+                return
+            data = self.map_source.tile_data(zoom, x, y)
+            if data is None:
+                continue
+            batch.append(((zoom, x, y), self.map_source.decode(zoom, x, y, data)))
+            if len(batch) >= PREFETCH_BATCH:
+                task.emit(batch)
+                batch = []
+        if batch:
+            task.emit(batch)
+
+    def on_tiles(self, batch):
+        for key, image in batch:
+            self.map_source.texture_cache.put(key, image.texture)
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# One store per file, shared by every map
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_tile_store(path=TILE_STORE_PATH):
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = TileStore(path)
+        return _stores[path]
+
+
+def start_cache_import(cache_dir='cache', path=TILE_STORE_PATH):
+    # Packs the old loose-file cache on first run, off the UI thread
+    def run():
+        store = get_tile_store(path)
+        if store.stats()['tiles'] or not os.path.isdir(cache_dir):
+            return
+        imported = store.import_cache_dir(cache_dir, MapSource().cache_key)
+        logging.info(f"Packed {imported} map tiles from {cache_dir}/ into {path}")
+
+    thread = threading.Thread(target=run, name='tile-import', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    # python tile_store.py [cache_dir] [pack]: packs a mapview cache directory
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else 'cache'
+    path = sys.argv[2] if len(sys.argv) > 2 else TILE_STORE_PATH
+    store = TileStore(path)
+    start = time.perf_counter()
+    imported = store.import_cache_dir(cache_dir)
+    print(f"Packed {imported} tiles in {time.perf_counter() - start:.1f} s: {store.stats()}")
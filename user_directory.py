@@ -0,0 +1,63 @@
+import threading
+
+from database_service import get_database_service
+from message_queries import USER_ID_FOR_USERNAME, USERNAME_FOR_USER_ID
+
+
+class UserDirectory:
+    # In-process id <-> username map, so rendering a conversation doesn't query the users table
+    # once per message. Only found users are cached (a username may be signed up at any time);
+    # DatabaseManager.update_user / delete_user invalidate the entries they change.
+    def __init__(self, db_path):
+        self.db = get_database_service(db_path)
+        self.lock = threading.Lock()
+        self.usernames = {}  # user id -> username
+        self.user_ids = {}  # username -> user id
+
+    def remember(self, user_id, username):
+        if user_id is None or username is None:
+            return
+        with self.lock:
+            previous = self.usernames.get(user_id)
+            if previous is not None and previous != username:
+                self.user_ids.pop(previous, None)
+            self.usernames[user_id] = username
+            self.user_ids[username] = user_id
+
+    def forget(self, user_id):
+        with self.lock:
+            username = self.usernames.pop(user_id, None)
+            if username is not None and self.user_ids.get(username) == user_id:
+                del self.user_ids[username]
+
+    def username(self, user_id):
+        with self.lock:
+            username = self.usernames.get(user_id)
+        if username is None:
+            row = self.db.fetchone(USERNAME_FOR_USER_ID, (user_id,))
+            if row is not None:
+                username = row[0]
+                self.remember(user_id, username)
+        return username
+
+    def user_id(self, username):
+        with self.lock:
+            user_id = self.user_ids.get(username)
+        if user_id is None:
+            row = self.db.fetchone(USER_ID_FOR_USERNAME, (username,))
+            if row is not None:
+                user_id = row[0]
+                self.remember(user_id, username)
+        return user_id
+
+
+# One directory per database file, shared by every manager
+_directories = {}
+_directories_lock = threading.Lock()
+
+
+def get_user_directory(db_path='comments.db'):
+    with _directories_lock:
+        if db_path not in _directories:
+            _directories[db_path] = UserDirectory(db_path)
+        return _directories[db_path]